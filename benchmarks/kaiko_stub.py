@@ -0,0 +1,212 @@
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import numpy as np
+
+# the benchmarks run from a checkout of the repository, kaiko_depth.py is in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kaiko_depth import _interval_ms, _to_ms
+from synthetic_depth import synthetic_prices, synthetic_snapshots
+
+# Instruments listed by the stub reference data (exchange x pair), as assets_depth() defaults
+STUB_EXCHANGES = ['krkn', 'cbse', 'stmp', 'bnus', 'binc', 'gmni', 'btrx', 'itbi', 'huob', 'btba']
+STUB_BASES = ['btc', 'eth', 'sol', 'ada', 'xrp', 'dot', 'link', 'matic', 'ltc', 'uni']
+STUB_QUOTES = ['usd', 'usdt', 'usdc', 'dai', 'busd']
+
+
+@lru_cache(maxsize=512)
+def _snapshots(exchange, pair, start, end, step, seed):
+    # most recent first, as the API; the records of a window are generated once and sliced into pages
+    return synthetic_snapshots(exchange, pair, np.arange(start + (-start) % step, end + 1, step), seed)
+
+
+@lru_cache(maxsize=512)
+def _prices(base, start, end, step, seed):
+    return synthetic_prices(base, np.arange(start + (-start) % step, end + 1, step), seed)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        if url.path.endswith('/_stats'):
+            return self._send(200, stub.stats(), count=False)
+        if stub.latency:
+            time.sleep(stub.latency)
+        if url.path.endswith('/instruments'):
+            stub._count('reference')
+            return self._send(200, {'result': 'success', 'data': stub.instruments()})
+        if 'ob_aggregations' in parts:
+            kind = 'depth'
+        elif 'spot_exchange_rate' in parts:
+            kind = 'price'
+        else:
+            return self._send(404, {'result': 'error', 'message': 'unknown endpoint'})
+        stub._count(kind)
+        if stub.error_rate and stub._random.random() < stub.error_rate:
+            stub._count('errors')
+            if stub.retry_after is not None:
+                return self._send(429, {'result': 'error', 'message': 'too many requests'}, headers={'Retry-After': f'{stub.retry_after:g}'})
+            return self._send(503, {'result': 'error', 'message': 'service unavailable'})
+        try:
+            start, end = _to_ms(query['start_time']), _to_ms(query['end_time'])
+            step = _interval_ms(query['interval'])
+        except (KeyError, ValueError):
+            return self._send(400, {'result': 'error', 'message': 'invalid parameters'})
+        if kind == 'depth':
+            exchange, instrument_class, pair = parts[parts.index('exchanges') + 1:parts.index('exchanges') + 4]
+            if not stub.is_listed(exchange, instrument_class, pair):
+                stub._count('not_found')
+                return self._send(404, {'result': 'error', 'message': f'{exchange}/{pair} not found'})
+            records = _snapshots(exchange, pair, start, end, step, stub.seed)
+        else:
+            base = parts[parts.index('spot_exchange_rate') + 1]
+            records = _prices(base, start, end, step, stub.seed)
+        offset = int(query.get('offset', 0))
+        body = {'result': 'success', 'data': records[offset:offset + stub.page_size]}
+        if offset + stub.page_size < len(records):
+            query['offset'] = offset + stub.page_size
+            body['next_url'] = f'http://{self.headers["Host"]}{url.path}?{urlencode(query)}'
+        self._send(200, body)
+
+    def _send(self, status, body, count=True, headers={}):
+        data = json.dumps(body).encode()
+        gzipped = self.server.stub.gzip and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            data = gzip.compress(data, compresslevel=5)
+        if count:
+            self.server.stub._count('bytes', len(data))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+'''
+The KaikoStub class is a local HTTP server that answers like the Kaiko API, to benchmark the module offline
+without using any API quota. It serves:
+    - .../ob_aggregations/full: synthetic order book snapshots (see synthetic_snapshots()), most recent first
+    - .../spot_exchange_rate/{base}/usd: synthetic USD prices (see synthetic_prices())
+    - /v1/instruments: the reference data of the STUB_EXCHANGES x STUB_BASES x STUB_QUOTES instruments
+The responses are paginated with next_url, page_size records per page, and the snapshots of an instrument that
+isn't listed are answered with a 404, as the API does. The requests received are counted (see stats()).
+
+PARAMETERS
+    - page_size (int): An optional parameter that specifies the number of records per page. The default value is 100.
+    - latency (float): An optional parameter that specifies the time (seconds) taken by each response. The default value is 0.
+    - error_rate (float): An optional parameter that specifies the share of data requests answered with a 503. The default value is 0.
+    - retry_after (float): An optional parameter that makes the injected errors 429 answers with this Retry-After (seconds). The default value is None (503 answers).
+    - unlisted_rate (float): An optional parameter that specifies the share of instruments that aren't listed. The default value is 0.
+    - gzip (bool): An optional parameter that compresses the responses when the client accepts gzip. The default value is True.
+    - seed (int): An optional parameter to change the generated data. The default value is 0.
+
+EXAMPLE
+    with KaikoStub(latency=0.02) as stub:
+        client = kk.KaikoClient('key', api_url=stub.api_url, reference_url=stub.reference_url, rate_limit=None)
+        df = kk.market_depth('key', start_time, end_time, 'eth-usd', ['cbse', 'krkn'], '1m', client=client)
+        print(stub.stats())
+'''
+class KaikoStub:
+    def __init__(self, page_size=100, latency=0.0, error_rate=0.0, unlisted_rate=0.0, gzip=True, seed=0, host='127.0.0.1', port=0, retry_after=None):
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.unlisted_rate = unlisted_rate
+        self.gzip = gzip
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self):
+        return self.url + '/v2/data'
+
+    @property
+    def reference_url(self):
+        return self.url + '/v1/instruments'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + value
+
+    '''
+    The stats() method returns the number of requests received by kind (depth, price, reference), of injected
+    errors, of 404 answers and the number of bytes sent. They are also served on /_stats (not counted).
+    '''
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+    def is_listed(self, exchange, instrument_class, pair):
+        base, _, quote = pair.partition('-')
+        if instrument_class != 'spot' or exchange not in STUB_EXCHANGES or base not in STUB_BASES or quote not in STUB_QUOTES:
+            return False
+        return zlib.crc32(f'{exchange}/{pair}/{self.seed}'.encode()) / 2 ** 32 >= self.unlisted_rate
+
+    def instruments(self):
+        return [{'exchange_code': exchange, 'class': 'spot', 'code': f'{base}-{quote}',
+                 'trade_start_time': '2018-01-01T00:00:00.000Z', 'trade_end_time': None}
+                for exchange in STUB_EXCHANGES for base in STUB_BASES for quote in STUB_QUOTES
+                if self.is_listed(exchange, 'spot', f'{base}-{quote}')]
+
+
+if __name__ == '__main__':
+    # serve the stub until interrupted, e.g. to point a notebook at it
+    stub = KaikoStub(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8765).start()
+    print(f'Kaiko API stub listening on {stub.api_url} (reference data on {stub.reference_url})')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,196 @@
+'''
+Offline benchmarks of kaiko_depth.py, against the local Kaiko API stub (see kaiko_stub.py).
+
+Each benchmark case (function x grid x window) runs in a fresh process, so that its peak RSS and the state of
+the module (e.g. the USD price cache) don't depend on the cases run before. The stub runs in this process and
+counts the requests of each case. For each case the report gives:
+    - seconds: wall time of the function
+    - snapshots and snapshots_per_s: snapshots returned (fetchers) or processed (create_json, heatmaps) per second
+    - requests: depth, price and reference data requests received by the stub, and errors: injected 503 answers
+    - rss_before_mb and peak_rss_mb: peak RSS of the process before the function, and at its end
+
+A grid is ASSETSxQUOTESxEXCHANGES (e.g. 2x2x3), taken in order from the instruments of the stub.
+
+EXAMPLES
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --grid 4x3x5 --window 1d --interval 1m --latency 0.05 --output bench.json
+    python benchmarks/run_benchmarks.py --compare bench.json
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+# the benchmarks run from a checkout of the repository, kaiko_depth.py is in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kaiko_stub import KaikoStub, STUB_BASES, STUB_EXCHANGES, STUB_QUOTES
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+FUNCTIONS = ['market_depth', 'asset_depth', 'assets_depth', 'create_json', 'market_heatmap', 'asset_heatmap', 'assets_heatmap']
+DEFAULT_GRIDS = ['1x2x2', '2x3x4']
+DEFAULT_WINDOWS = ['1h', '6h']
+WINDOW_END = '2023-02-08T00:00:00Z'
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def _grid(grid):
+    assets, quotes, exchanges = (int(size) for size in grid.split('x'))
+    return STUB_BASES[:assets], STUB_QUOTES[:quotes], STUB_EXCHANGES[:exchanges]
+
+
+def _window(window):
+    end = pd.Timestamp(WINDOW_END)
+    return (end - pd.Timedelta(window)).strftime('%Y-%m-%dT%H:%M:%SZ'), WINDOW_END
+
+
+def _run_case(case, settings, results):
+    # runs in a fresh process: fetch the input of the function if it needs one, then time the function alone
+    import kaiko_depth as kk
+    from urllib.request import urlopen
+
+    def stub_stats():
+        with urlopen(settings['stub_url'] + '/_stats') as res:
+            return json.load(res)
+
+    bases, quotes, exchanges = _grid(case['grid'])
+    start_time, end_time = _window(case['window'])
+    interval = settings['interval']
+    client = kk.KaikoClient('benchmark', api_url=settings['stub_url'] + '/v2/data', reference_url=settings['stub_url'] + '/v1/instruments',
+                            rate_limit=settings['rate_limit'], backoff=settings['backoff'], max_backoff=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        instruments_file = os.path.join(tmp, 'instruments.json')
+        kk.load_instruments(instruments_file, client=client)
+        fetchers = {
+            'market_depth': lambda: kk.market_depth('benchmark', start_time, end_time, f'{bases[0]}-{quotes[0]}', exchanges, interval,
+                                                    max_workers=settings['max_workers'], client=client),
+            'asset_depth': lambda: kk.asset_depth('benchmark', start_time, end_time, bases[0], exchanges, interval, quote_assets=quotes,
+                                                  max_workers=settings['max_workers'], instruments_file=instruments_file, client=client),
+            'assets_depth': lambda: kk.assets_depth('benchmark', start_time, end_time, bases, 'spot', interval, exchanges=exchanges,
+                                                    quote_assets=quotes, max_workers=settings['max_workers'],
+                                                    instruments_file=instruments_file, client=client),
+        }
+        renderers = {
+            'create_json': ('assets_depth', lambda df: kk.create_json(df, os.path.join(tmp, 'depth.json'), usd=True)),
+            'market_heatmap': ('assets_depth', lambda df: kk.market_heatmap(df, os.path.join(tmp, 'market.jpeg'))),
+            'asset_heatmap': ('asset_depth', lambda df: kk.asset_heatmap(df, os.path.join(tmp, 'asset.jpeg'))),
+            'assets_heatmap': ('assets_depth', lambda df: kk.assets_heatmap(df, os.path.join(tmp, 'assets.jpeg'))),
+        }
+        df = None
+        if case['function'] in renderers:
+            source, run = renderers[case['function']]
+            df = fetchers[source]()
+        rss_before = _peak_rss_mb()
+        stats_before = stub_stats()
+        started = time.perf_counter()
+        if df is None:
+            df = fetchers[case['function']]()
+        else:
+            run(df)
+        seconds = time.perf_counter() - started
+        stats = stub_stats()
+    requests = {name: stats.get(name, 0) - stats_before.get(name, 0) for name in ('depth', 'price', 'reference', 'errors', 'bytes')}
+    results.put(dict(case, seconds=round(seconds, 4), snapshots=len(df), snapshots_per_s=round(len(df) / seconds) if seconds else None,
+                     requests=requests['depth'] + requests['price'] + requests['reference'], errors=requests['errors'],
+                     mb_received=round(requests['bytes'] / (1 << 20), 2), rss_before_mb=rss_before, peak_rss_mb=_peak_rss_mb()))
+
+
+'''
+The run_benchmarks() function runs every case of functions x grids x windows against a local stub,
+and returns the results as a DataFrame (one row per case).
+
+PARAMETERS
+    - functions (list of strings): An optional parameter, the functions to time (see FUNCTIONS). The default value is all of them.
+    - grids (list of strings): An optional parameter, the ASSETSxQUOTESxEXCHANGES grids. The default value is ['1x2x2', '2x3x4'].
+    - windows (list of strings): An optional parameter, the window lengths (e.g. "1h", "1d"). The default value is ['1h', '6h'].
+    - interval (string): An optional parameter that specifies the interval of the snapshots. The default value is "1m".
+    - latency, error_rate, page_size, unlisted_rate: Optional parameters of the stub (see KaikoStub).
+    - max_workers, rate_limit: Optional parameters of the fetch engine. rate_limit is disabled by default.
+    - backoff (float): An optional parameter, the base delay of the retries of the client (seconds). The default value is 0.05.
+'''
+def run_benchmarks(functions=FUNCTIONS, grids=DEFAULT_GRIDS, windows=DEFAULT_WINDOWS, interval='1m', latency=0.01, error_rate=0.0,
+                   page_size=100, unlisted_rate=0.1, max_workers=8, rate_limit=None, backoff=0.05, verbose=True):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    rows = []
+    with KaikoStub(page_size=page_size, latency=latency, error_rate=error_rate, unlisted_rate=unlisted_rate) as stub:
+        settings = {'stub_url': stub.url, 'interval': interval, 'max_workers': max_workers, 'rate_limit': rate_limit, 'backoff': backoff}
+        for grid in grids:
+            for window in windows:
+                for function in functions:
+                    case = {'function': function, 'grid': grid, 'window': window, 'interval': interval}
+                    process = context.Process(target=_run_case, args=(case, settings, results))
+                    process.start()
+                    process.join()
+                    if process.exitcode != 0:
+                        print(f'benchmark failed: {function} {grid} {window}')
+                        continue
+                    rows.append(results.get())
+                    if verbose:
+                        row = rows[-1]
+                        print(f"{function:>15} {grid:>8} {window:>4}  {row['seconds']:8.3f}s  {row['snapshots']:>8} snapshots  "
+                              f"{row['requests']:>5} requests  peak RSS {row['peak_rss_mb']:.0f} MB")
+    return pd.DataFrame(rows)
+
+
+'''
+The compare() function joins the results with the ones of a previous run (JSON file written with --output),
+and flags the cases that got slower than threshold times the baseline.
+'''
+def compare(results, baseline_file, threshold=1.2):
+    baseline = pd.read_json(baseline_file)
+    keys = ['function', 'grid', 'window', 'interval']
+    joined = results.merge(baseline[keys + ['seconds', 'peak_rss_mb']], on=keys, how='left', suffixes=('', '_baseline'))
+    joined['speedup'] = (joined['seconds_baseline'] / joined['seconds']).round(2)
+    joined['regression'] = joined['seconds'] > threshold * joined['seconds_baseline']
+    return joined
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of kaiko_depth.py against a local Kaiko API stub.')
+    parser.add_argument('--function', action='append', choices=FUNCTIONS, help='function to time (repeatable), all by default')
+    parser.add_argument('--grid', action='append', help=f'ASSETSxQUOTESxEXCHANGES grid (repeatable), default {" ".join(DEFAULT_GRIDS)}')
+    parser.add_argument('--window', action='append', help=f'window length (repeatable), default {" ".join(DEFAULT_WINDOWS)}')
+    parser.add_argument('--interval', default='1m')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per stub response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of data requests answered with a 503')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--unlisted-rate', type=float, default=0.1, help='share of instruments not listed')
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--rate-limit', type=float, default=None)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown flagged as a regression by --compare')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.function or FUNCTIONS, args.grid or DEFAULT_GRIDS, args.window or DEFAULT_WINDOWS, args.interval,
+                             args.latency, args.error_rate, args.page_size, args.unlisted_rate, args.max_workers, args.rate_limit)
+    columns = ['function', 'grid', 'window', 'seconds', 'snapshots', 'snapshots_per_s', 'requests', 'errors', 'mb_received', 'peak_rss_mb']
+    if args.compare:
+        results = compare(results, args.compare, args.threshold)
+        columns += ['seconds_baseline', 'speedup', 'regression']
+    print()
+    print(results[columns].to_string(index=False))
+    if args.output:
+        results.drop(columns=['seconds_baseline', 'peak_rss_mb_baseline', 'speedup', 'regression'], errors='ignore').to_json(args.output, orient='records', indent=1)
+    if args.compare and results['regression'].any():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import zlib
+
+import numpy as np
+
+# the benchmarks run from a checkout of the repository, kaiko_depth.py is in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kaiko_depth import DEPTH_COLUMNS, DEPTH_PCTS
+
+# Rough USD prices of the assets used by the benchmarks, other assets get a stable pseudo-random price
+ASSET_PRICES_USD = {'btc': 23000.0, 'eth': 1600.0, 'sol': 24.0, 'ada': 0.39, 'xrp': 0.4, 'dot': 6.5, 'link': 7.0,
+                    'matic': 1.3, 'ltc': 95.0, 'uni': 6.8, 'avax': 20.0, 'atom': 13.0, 'doge': 0.09, 'bnb': 330.0,
+                    'usd': 1.0, 'usdt': 1.0, 'usdc': 1.0, 'dai': 1.0, 'busd': 1.0, 'eur': 1.08}
+
+STABLE_ASSETS = {'usd', 'usdt', 'usdc', 'dai', 'busd'}
+
+
+def _seed(*parts):
+    return zlib.crc32('/'.join(str(part) for part in parts).encode())
+
+
+def asset_price_usd(asset):
+    if asset in ASSET_PRICES_USD:
+        return ASSET_PRICES_USD[asset]
+    return float(10 ** np.random.default_rng(_seed('price', asset)).uniform(-1, 3))
+
+
+def _splitmix(x):
+    # splitmix64 finalizer, element-wise on uint64 arrays (wrapping arithmetic)
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _normals(key, timestamps, size):
+    # standard normal values of shape (timestamps, size) that only depend on key and on each timestamp (Box-Muller),
+    # so that a snapshot is the same whatever the window it is requested with
+    with np.errstate(over='ignore'):
+        counters = _splitmix(timestamps.astype(np.uint64) ^ np.uint64(key))[:, None] + np.arange(2 * size, dtype=np.uint64)[None, :]
+        uniforms = ((_splitmix(counters) >> np.uint64(11)).astype(np.float64) + 0.5) / 2.0 ** 53
+    return np.sqrt(-2 * np.log(uniforms[:, :size])) * np.cos(2 * np.pi * uniforms[:, size:])
+
+
+def _price_path(rng, price, timestamps, volatility):
+    # price wandering around its reference price: a sum of cycles of a few hours to a month with random phases and
+    # amplitudes (volatility is the daily volatility), a function of the timestamp only
+    periods = np.array([4, 24, 24 * 7, 24 * 30]) * 3600000.0
+    amplitudes = volatility * np.sqrt(periods / 86400000) * rng.uniform(0.3, 1.0, len(periods))
+    phases = rng.uniform(0, 2 * np.pi, len(periods))
+    cycles = amplitudes[None, :] * np.sin(2 * np.pi * timestamps[:, None] / periods[None, :] + phases[None, :])
+    return price * np.exp(cycles.sum(axis=1))
+
+
+'''
+The synthetic_snapshots() function generates order book snapshots of one instrument in the format of the
+ob_aggregations/full endpoint (numbers as strings, one record per poll_timestamp, most recent first).
+
+The depths look like the ones of a real order book:
+    - the mid price wanders around the USD price of the base (slow cycles and noise), in quote units
+    - each instrument has its own liquidity (log-normal across instruments), in USD at 10% from the mid price
+    - the cumulative depth grows with the distance to the mid price (concave curve), level after level
+    - bid and ask sides are imbalanced, and the liquidity varies during the day and from a snapshot to the next
+Each snapshot only depends on the exchange, the pair, its timestamp and the seed: a snapshot is the same whatever the
+window, the shard or the poll it is requested with.
+
+PARAMETERS
+    - exchange (string): A required parameter that specifies the exchange code (e.g. "cbse").
+    - pair (string): A required parameter that specifies the pair (e.g. "eth-usd").
+    - timestamps (array of int): A required parameter, the poll timestamps (ms) of the snapshots, in ascending order.
+    - seed (int): An optional parameter to change the generated data. The default value is 0.
+'''
+def synthetic_snapshots(exchange, pair, timestamps, seed=0):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    n = len(timestamps)
+    if n == 0:
+        return []
+    # parameters of the instrument, drawn in a fixed order
+    key = _seed(exchange, pair, seed)
+    rng = np.random.default_rng(key)
+    base, _, quote = pair.partition('-')
+    pcts = np.asarray(DEPTH_PCTS)
+    # liquidity of the instrument (USD at 10%), intraday cycle, shape of the depth curve, imbalance and spread
+    liquidity = 10 ** rng.normal(6.3, 0.6)
+    cycle_phase = rng.uniform(0, 2 * np.pi)
+    curve = (pcts / pcts[-1]) ** rng.uniform(0.55, 0.85)
+    imbalances = np.exp(rng.normal(0, 0.15, 2))
+    relative_spread = rng.uniform(0.00005, 0.001)
+    # values of each snapshot, from its timestamp
+    noise = _normals(key, timestamps, 2 * len(pcts) + 2)
+    mid = _price_path(rng, asset_price_usd(base) / asset_price_usd(quote), timestamps, 0.04) * np.exp(0.0005 * noise[:, -1])
+    cycle = 1 + 0.3 * np.sin(2 * np.pi * (timestamps % 86400000) / 86400000 + cycle_phase)
+    increments = np.diff(curve, prepend=0.0)
+    sides = []
+    for side, imbalance in enumerate(imbalances):
+        # (snapshots, levels) increments, summed level after level so that the depth is cumulative
+        levels_noise = np.exp(0.25 * noise[:, side * len(pcts):(side + 1) * len(pcts)])
+        usd = liquidity * imbalance * cycle[:, None] * increments[None, :] * levels_noise
+        sides.append(np.cumsum(usd, axis=1) / (mid * asset_price_usd(quote))[:, None])
+    volumes = np.concatenate(sides, axis=1)
+    spread = mid * relative_spread * np.exp(0.3 * noise[:, -2])
+
+    volume_strings = np.char.mod('%.8f', volumes)
+    mid_strings = np.char.mod('%.8f', mid)
+    spread_strings = np.char.mod('%.8f', spread)
+    records = []
+    for i in range(n - 1, -1, -1):
+        record = {'poll_timestamp': int(timestamps[i]), 'ask_slippage': None, 'bid_slippage': None}
+        record.update(zip(DEPTH_COLUMNS, volume_strings[i].tolist()))
+        record['mid_price'] = mid_strings[i].item()
+        record['spread'] = spread_strings[i].item()
+        records.append(record)
+    return records
+
+
+'''
+The synthetic_prices() function generates the USD price of an asset in the format of the spot_exchange_rate
+endpoint, one record per timestamp in ascending order. A stable asset has a price of 1.
+
+PARAMETERS
+    - base (string): A required parameter that specifies the asset (e.g. "eth").
+    - timestamps (array of int): A required parameter, the timestamps (ms) of the prices, in ascending order.
+    - seed (int): An optional parameter to change the generated data. The default value is 0.
+'''
+def synthetic_prices(base, timestamps, seed=0):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if base in STABLE_ASSETS:
+        prices = np.ones(len(timestamps))
+    else:
+        key = _seed('usd', base, seed)
+        prices = _price_path(np.random.default_rng(key), asset_price_usd(base), timestamps, 0.04) * np.exp(0.0005 * _normals(key, timestamps, 1)[:, 0])
+    return [{'timestamp': int(timestamp), 'price': price}
+            for timestamp, price in zip(timestamps.tolist(), np.char.mod('%.8f', prices).tolist())]
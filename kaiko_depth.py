@@ -1,6 +1,1265 @@
+import copy
+import json
+import os
+import queue
+import random
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import requests
-import matplotlib.pyplot as plt
+import requests.adapters
+
+API_URL = 'https://us.market-api.kaiko.io/v2/data'
+REFERENCE_URL = 'https://reference-data-api.kaiko.io/v1/instruments'
+
+# Depth levels returned by the ob_aggregations/full endpoint (% distance to the mid price), for the bid and ask sides
+DEPTH_LEVELS = ['0_1', '0_2', '0_3', '0_4', '0_5', '0_6', '0_7', '0_8', '0_9', '1', '1_5', '2', '4', '6', '8', '10']
+DEPTH_PCTS = [float(level.replace('_', '.')) for level in DEPTH_LEVELS]
+DEPTH_COLUMNS = [f'{side}_volume{level}' for side in ('bid', 'ask') for level in DEPTH_LEVELS]
+
+# Columns identifying the instrument of a snapshot
+INSTRUMENT_KEYS = ['base', 'pair', 'exchange']
+
+# Fetch engine defaults: number of requests in flight, and requests per second allowed per API host
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_RATE_LIMIT = 10
+
+# Long windows are split into time shards of at most SHARD_PAGES pages, downloaded concurrently (see fetch_depth()),
+# and a shard that fails is downloaded again up to SHARD_RETRIES times
+SHARD_PAGES = 20
+SHARD_RETRIES = 2
+
+# Fetch engine
+
+'''
+The _RateLimiter class spaces out requests sent to a same host so that the fan-out of the fetch engine
+stays within the API quota. It is shared by all the worker threads of a fetch.
+'''
+class _RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, url):
+        # returns the time (seconds) spent waiting for a slot
+        if not self.rate:
+            return 0.0
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+            return slot - now
+        return 0.0
+
+
+# HTTP client
+
+'''
+The KaikoAPIError exception is raised by KaikoClient when the API answers with an error that is not retried
+(e.g. 404 for an instrument that is not listed), when the retries are exhausted, or when the API asks to retry
+later than max_retry_after.
+'''
+class KaikoAPIError(Exception):
+    def __init__(self, status_code, url, message=''):
+        super().__init__(f'{status_code} {message} ({url})')
+        self.status_code = status_code
+        self.url = url
+
+
+'''
+The KaikoClient class is the HTTP client shared by all the fetchers of the module. It keeps a pooled
+requests.Session (keep-alive connections reused across requests and threads), asks for gzip compressed
+responses, spaces out requests per host (rate_limit) and retries the requests that fail with 429/5xx or a network
+error, with exponential backoff and jitter, honoring the Retry-After header of the API: the client waits the whole
+Retry-After delay, or raises a KaikoAPIError when it is longer than max_retry_after.
+
+The API urls are attributes of the client, so that tests and benchmarks can point it at a local stub server.
+
+The client reports what it does to its hooks: callables hook(event, data) called with the 'request' events of the
+client (see get_json()) and the 'job', 'cache' and 'stage' events of the fetch engine, data being a dict that always
+holds the tags of the instrument concerned (e.g. {'pair': 'btc-usd', 'exchange': 'cbse'}). A FetchReport is such a hook.
+The hooks are called from the fetch threads: they must be thread-safe and fast.
+
+PARAMETERS
+    - apikey (string): A required parameter that specifies the API key to access the market data (None for the reference data only).
+    - api_url (string): An optional parameter that specifies the market data API url. The default value is API_URL.
+    - reference_url (string): An optional parameter that specifies the instruments reference data url. The default value is REFERENCE_URL.
+    - timeout (float or tuple): An optional parameter that specifies the (connect, read) timeouts in seconds. The default value is (10, 60).
+    - max_retries (int): An optional parameter that specifies the number of retries of a failed request. The default value is 5.
+    - backoff (float): An optional parameter that specifies the base delay (seconds) of the exponential backoff. The default value is 0.5.
+    - max_backoff (float): An optional parameter that specifies the maximum delay (seconds) of the backoff between two attempts. The default value is 30.
+    - max_retry_after (float): An optional parameter that specifies the longest Retry-After (seconds) the client waits for. The default value is 300.
+    - rate_limit (float): An optional parameter that specifies the maximum number of requests per second sent to a host. The default value is 10.
+    - pool_size (int): An optional parameter that specifies the number of pooled connections per host. The default value is 16.
+    - session (requests.Session): An optional parameter to provide your own session. The default value is None (a new session).
+    - hooks (list of callables): An optional parameter that specifies the hooks called with the events of the client. The default value is None (no hook).
+
+EXAMPLE
+    client = KaikoClient(apikey, max_retries=3)
+    df = market_depth(apikey, start_time, end_time, 'eth-usd', ['cbse', 'krkn'], '1m', client=client)
+'''
+class KaikoClient:
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, apikey, api_url=None, reference_url=None, timeout=(10, 60), max_retries=5, backoff=0.5,
+                 max_backoff=30, rate_limit=DEFAULT_RATE_LIMIT, pool_size=2 * DEFAULT_MAX_WORKERS, session=None, hooks=None, max_retry_after=300):
+        # the module urls are read when the client is created, so that they can still be overridden module-wide
+        self.api_url = api_url or API_URL
+        self.reference_url = reference_url or REFERENCE_URL
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.limiter = _RateLimiter(rate_limit)
+        self.session = session if session is not None else requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept': 'application/json',
+                                     'Accept-Encoding': 'gzip'})
+        if apikey is not None:
+            self.session.headers['X-Api-Key'] = apikey
+        self.hooks = list(hooks or [])
+        # instrument of the requests sent, added to the events (see traced())
+        self.tags = {}
+        # number of records of a full page, by endpoint, as observed by the fetch engine (shared by the views of the client)
+        self.page_sizes = {}
+        # USD prices downloaded with this client (shared by its views), see PriceCache
+        self.price_cache = PriceCache()
+
+    '''
+    The traced() method returns a view of the client, sharing its session and rate limiter, whose events also go to
+    hook (e.g. the FetchReport of a single call), and/or are tagged with the instrument the requests are sent for.
+    '''
+    def traced(self, hook=None, tags=None):
+        view = copy.copy(self)
+        if hook is not None:
+            view.hooks = self.hooks + [hook]
+        if tags is not None:
+            view.tags = tags
+        return view
+
+    def emit(self, event, **data):
+        if not self.hooks:
+            return
+        data.setdefault('tags', self.tags)
+        for hook in self.hooks:
+            hook(event, data)
+
+    def _delay(self, attempt, res=None):
+        retry_after = res.headers.get('Retry-After') if res is not None else None
+        if retry_after:
+            # the delay asked by the API is waited entirely, see get_json()
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    '''
+    The get_json() method sends a GET request and returns the parsed JSON body, retrying as described above.
+    Each call emits a 'request' event with its url, status (None after a network error), attempts, seconds (whole call),
+    latency (last attempt, download included), wait (rate limiting), retry_wait (backoff), bytes (decompressed body),
+    wire_bytes (as received), decode (JSON parsing, seconds) and records (size of the data page).
+    '''
+    def get_json(self, url):
+        started = time.perf_counter()
+        waits = [0.0, 0.0]
+        for attempt in range(self.max_retries + 1):
+            waits[0] += self.limiter.wait(url)
+            sent = time.perf_counter()
+            try:
+                res = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    self._emit_request(url, None, attempt, started, sent, waits)
+                    raise
+                waits[1] += self._sleep(self._delay(attempt))
+                continue
+            delay = None
+            if res.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                delay = self._delay(attempt, res)
+                if delay <= self.max_retry_after:
+                    waits[1] += self._sleep(delay)
+                    continue
+            if res.status_code >= 400:
+                self._emit_request(url, res, attempt, started, sent, waits)
+                try:
+                    message = res.json().get('message', '')
+                except ValueError:
+                    message = res.reason
+                if delay is not None:
+                    # retrying sooner than asked would only be throttled again
+                    message = f'{message}, Retry-After {delay:g}s is longer than max_retry_after'
+                raise KaikoAPIError(res.status_code, url, message)
+            received = time.perf_counter()
+            body = res.json()
+            if self.hooks:
+                records = body.get('data') if isinstance(body, dict) else None
+                self._emit_request(url, res, attempt, started, sent, waits, received, time.perf_counter() - received,
+                                   len(records) if isinstance(records, list) else 0)
+            return body
+
+    @staticmethod
+    def _sleep(delay):
+        time.sleep(delay)
+        return delay
+
+    def _emit_request(self, url, res, attempt, started, sent, waits, received=None, decode=0.0, records=0):
+        received = received or time.perf_counter()
+        size = len(res.content) if res is not None else 0
+        self.emit('request', url=url, status=res.status_code if res is not None else None, attempts=attempt + 1,
+                  seconds=received - started, latency=received - sent, wait=waits[0], retry_wait=waits[1], bytes=size,
+                  wire_bytes=int(res.headers.get('Content-Length', size)) if res is not None else 0, decode=decode, records=records)
+
+    def depth_url(self, exchange, instrument_class, instrument, start_time, end_time, interval):
+        return depth_url(exchange, instrument_class, instrument, start_time, end_time, interval, self.api_url)
+
+    def crossprice_url(self, base, quote, start_time, end_time, interval):
+        return crossprice_url(base, quote, start_time, end_time, interval, self.api_url)
+
+
+def _client(client, rate_limit=DEFAULT_RATE_LIMIT):
+    # The engine functions accept a KaikoClient or an API key
+    return client if isinstance(client, KaikoClient) else KaikoClient(client, rate_limit=rate_limit)
+
+
+'''
+The _iter_pages() generator follows the next_url pagination of an endpoint and yields the records of each page.
+Each response body is parsed once, and the request of the next page is sent as soon as its url is known,
+so that page N+1 is downloaded while page N is consumed.
+'''
+def _iter_pages(client, url):
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        body = client.get_json(url)
+        while True:
+            next_url = body.get('next_url')
+            pending = prefetcher.submit(client.get_json, next_url) if next_url else None
+            yield body['data']
+            if pending is None:
+                return
+            body = pending.result()
+
+
+def _get_records(client, url):
+    # Accumulate the raw records of all pages, the DataFrame is built once by the caller
+    records = []
+    for page in _iter_pages(client, url):
+        records.extend(page)
+    return records
+
+
+def _fan_out(func, items, max_workers):
+    # Run func over items on a bounded thread pool; results come back in the order of items
+    if max_workers is None or max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        return list(pool.map(func, items))
+
+
+def depth_url(exchange, instrument_class, instrument, start_time, end_time, interval, api_url=API_URL):
+    return f'{api_url}/order_book_snapshots.v1/exchanges/{exchange}/{instrument_class}/{instrument}/ob_aggregations/full?start_time={start_time}&end_time={end_time}&interval={interval}'
+
+
+def crossprice_url(base, quote, start_time, end_time, interval, api_url=API_URL):
+    return f'{api_url}/trades.v1/spot_exchange_rate/{base}/{quote}?start_time={start_time}&end_time={end_time}&interval={interval}'
+
+
+def _run_jobs(client, jobs, get_records, build, max_workers, on_done=None):
+    # The tags of a job are always its last field, get_records(client, job) downloads its records with a client
+    # tagged with the job, build(records, tags) makes the result of the job, and on_done(job, result) is called
+    # from the thread of the job as soon as it is done (result None if it failed)
+    def fetch(job):
+        tags = job[-1]
+        job_client = client.traced(tags=tags)
+        started = time.perf_counter()
+        try:
+            records = get_records(job_client, job)
+        except Exception as exc:
+            print('not available: ' + ' / '.join(str(value) for value in tags.values()))
+            job_client.emit('job', seconds=time.perf_counter() - started, build=0.0, records=0, error=str(exc))
+            result = None
+        else:
+            built = time.perf_counter()
+            result = build(records, tags)
+            job_client.emit('job', seconds=time.perf_counter() - started, build=time.perf_counter() - built, records=len(records), error=None)
+        if on_done is not None:
+            on_done(job, result)
+        return result
+    return _fan_out(fetch, jobs, max_workers)
+
+
+def _build_frame(records, tags):
+    df = pd.DataFrame(records)
+    for column, value in tags.items():
+        df[column] = (value)
+    return df
+
+
+'''
+The fetch_frames() function is the generic fetch engine, used for the USD prices (see PriceCache).
+It downloads every requested url (following the pagination) concurrently, and returns one DataFrame per job,
+in the same order as the jobs. Jobs that fail (e.g. instrument not listed) are reported and returned as None.
+
+PARAMETERS
+    - client (KaikoClient or string): A required parameter that specifies the client (or the API key) used to send the requests.
+    - jobs (list of tuples): A required parameter, each job being a (url, tags) tuple. tags is a dict of columns
+      (e.g. {'pair': 'btc-usd', 'exchange': 'cbse'}) added to the DataFrame of the job.
+    - max_workers (int): An optional parameter that specifies the maximum number of requests in flight. The default value is 8.
+    - rate_limit (float): An optional parameter that specifies the maximum number of requests per second sent to a host,
+      when client is an API key. The default value is 10. Use None to disable the rate limiting.
+'''
+def fetch_frames(client, jobs, max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT):
+    client = _client(client, rate_limit)
+    def get_records(client, job):
+        return _get_records(client, job[0])
+    return _run_jobs(client, jobs, get_records, _build_frame, max_workers)
+
+
+'''
+A DepthJob describes the order book snapshots of one instrument (exchange + pair) over a time window.
+tags is a dict of columns (e.g. {'pair': 'btc-usd', 'exchange': 'cbse'}) added to the DataFrame of the job.
+'''
+DepthJob = namedtuple('DepthJob', ['exchange', 'instrument_class', 'instrument', 'start_time', 'end_time', 'interval', 'tags'])
+
+
+def _shard_span(job, client, shards_per_job, shard_pages):
+    # length (ms) of the time shards of a job: a whole number of pages, the page size being the one observed
+    # on the previous responses, enough shards to keep the workers busy, and at most shard_pages pages per shard
+    page_span = _interval_ms(job.interval) * client.page_sizes.get('ob_aggregations', DEFAULT_PAGE_SIZE)
+    window_pages = -(-(_to_ms(job.end_time) + 1 - _to_ms(job.start_time)) // page_span)
+    return page_span * max(1, min(shard_pages, -(-window_pages // shards_per_job)))
+
+
+def _shards(start, end, span):
+    # split the time range [start, end) into shards of span ms, the most recent first
+    return [(shard_start, min(end, shard_start + span)) for shard_start in range(start, end, span)][::-1]
+
+
+'''
+The _download_shards() function downloads the time shards [start, end) of a DepthJob concurrently on pool, and
+returns their records, newest first. store(start, end, records) is called as soon as a shard is complete, so that
+a failure leaves the other shards stored (e.g. in the SnapshotCache). A shard that fails with a network error, or
+once the retries of the client are exhausted, is downloaded again on its own, up to retries times; an error that
+isn't retried (e.g. 404 for an instrument that is not listed) fails the job, its shards not started yet are skipped.
+'''
+def _download_shards(client, job, shards, pool, store=None, retries=SHARD_RETRIES):
+    failed = threading.Event()
+    def download(shard):
+        if failed.is_set():
+            return None
+        url = client.depth_url(job.exchange, job.instrument_class, job.instrument, _to_iso(shard[0]), _to_iso(shard[1] - 1), job.interval)
+        for attempt in range(retries + 1):
+            try:
+                pages = list(_iter_pages(client, url))
+                break
+            except KaikoAPIError as exc:
+                if exc.status_code not in KaikoClient.RETRY_STATUS:
+                    failed.set()
+                if failed.is_set() or attempt == retries:
+                    raise
+            except requests.RequestException:
+                if attempt == retries:
+                    raise
+        if len(pages) > 1:
+            client.page_sizes['ob_aggregations'] = len(pages[0])
+        records = [record for page in pages for record in page]
+        if store is not None:
+            store(shard[0], shard[1], records)
+        return records
+    futures = [pool.submit(download, shard) for shard in shards]
+    parts, error = [], None
+    for future in futures:
+        try:
+            parts.append(future.result())
+        except Exception as exc:
+            error = error or exc
+    if error is not None:
+        raise error
+    return parts
+
+
+def _stitch(parts):
+    # records of the shards of a window, newest first; a snapshot returned at the boundary of two shards is kept once
+    if len(parts) == 1:
+        return parts[0]
+    records, seen = [], set()
+    for part in parts:
+        for record in part:
+            if record['poll_timestamp'] not in seen:
+                seen.add(record['poll_timestamp'])
+                records.append(record)
+    return records
+
+
+'''
+The fetch_depth() function is the fetch engine shared by market_depth(), asset_depth() and assets_depth().
+It works as fetch_frames(), for a list of DepthJob, and returns one DepthBlock per job (None if the job failed).
+When a SnapshotCache is given, the snapshots already stored in the cache are read from it and only the missing
+time ranges are downloaded.
+
+A long window is not downloaded as a single chain of pages: it is split into time shards of whole pages (at most
+shard_pages pages, sized from the interval and the page size of the previous responses), which are downloaded
+concurrently with the shards of the other jobs and stitched back together by poll_timestamp. A shard that fails is
+downloaded again on its own; with a cache, each shard is stored as soon as it is complete, so that a job that still
+fails only downloads its missing shards the next time.
+
+PARAMETERS
+    - client (KaikoClient or string): A required parameter that specifies the client (or the API key) used to send the requests.
+    - jobs (list of DepthJob): A required parameter that specifies the instruments and time windows to retrieve.
+    - max_workers (int): An optional parameter that specifies the maximum number of requests in flight. The default value is 8.
+    - rate_limit (float): An optional parameter that specifies the maximum number of requests per second sent to a host, when client is an API key. The default value is 10.
+    - cache (SnapshotCache): An optional parameter that specifies the on-disk cache to use. The default value is None (no cache).
+    - refresh (bool): An optional parameter that forces the download of the whole window, overwriting the cached snapshots. The default value is False.
+    - shard_pages (int): An optional parameter that specifies the maximum number of pages of a time shard. The default value is SHARD_PAGES (20). Use None to download each window as a single chain of pages.
+    - on_done (callable): An optional parameter, called as on_done(job, block) from the fetch threads as soon as each job is done (block is None if the job failed). The default value is None.
+'''
+def fetch_depth(client, jobs, max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, cache=None, refresh=False, shard_pages=SHARD_PAGES,
+                on_done=None):
+    client = _client(client, rate_limit)
+    max_workers = max(1, max_workers or 1)
+    shards_per_job = -(-max_workers // max(1, len(jobs)))
+    def get_records(client, job):
+        start, end = _to_ms(job.start_time), _to_ms(job.end_time) + 1
+        ranges = [(start, end)] if cache is None or refresh else cache.missing_ranges(job)
+        span = _shard_span(job, client, shards_per_job, shard_pages) if shard_pages else end - start
+        shards = [shard for range_start, range_end in ranges[::-1] for shard in _shards(range_start, range_end, span)]
+        if cache is None:
+            return _stitch(_download_shards(client, job, shards, pool))
+        parts = _download_shards(client, job, shards, pool, store=lambda start, end, records: cache.store(job, start, end, records))
+        records = cache.read(job)
+        if shards:
+            cache.evict()
+        client.emit('cache', kind='depth', hit=not shards, ranges=len(ranges), cached=max(0, len(records) - sum(map(len, parts))))
+        return records
+    # the shards run on their own pool, the threads of the jobs wait for them and parse the records of their job
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return _run_jobs(client, jobs, get_records, DepthBlock.from_records, max_workers, on_done)
+
+
+# Instrumentation
+
+# Upper bounds (seconds) of the buckets of the request latency histogram exported by FetchReport.to_prometheus()
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Counters of a FetchReport, by instrument: (name, help) of the metric exported by FetchReport.to_prometheus()
+_REPORT_COUNTERS = {
+    'pages': 'pages of data downloaded',
+    'requests': 'HTTP requests sent, retries included',
+    'retries': 'HTTP requests retried (429, 5xx or network error)',
+    'request_errors': 'requests that failed after the retries or with an error that is not retried',
+    'bytes': 'response bytes, decompressed',
+    'wire_bytes': 'response bytes, as received',
+    'records': 'records downloaded',
+    'request_seconds': 'time spent in requests (rate limiting and retries included)',
+    'latency_seconds': 'time spent waiting for the responses (download included)',
+    'wait_seconds': 'time spent waiting for the rate limiter',
+    'retry_wait_seconds': 'time spent waiting between retries',
+    'decode_seconds': 'time spent parsing the JSON responses',
+    'jobs': 'jobs run (instrument x time window)',
+    'job_failures': 'jobs that failed (e.g. instrument not listed)',
+    'job_seconds': 'time spent in the jobs, download and parsing',
+    'build_seconds': 'time spent parsing the records of the jobs into blocks or DataFrames',
+    'cache_hits': 'jobs entirely served by a cache',
+    'cache_misses': 'jobs that downloaded at least one time range missing from a cache',
+    'cached_records': 'records read from a cache',
+}
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _prometheus_value(value):
+    # counts are written exactly and durations with all their digits, rate() needs every increment
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return repr(float(value))
+
+
+'''
+The FetchReport class records what a fetch spent its time on: it is a client hook (see KaikoClient) aggregating
+the events of the fetch engine by instrument (pages, requests, retries, bytes, latency, rate limiting, JSON decoding,
+parsing, cache hits), the latency histogram of the requests, the time spent in each stage of the fetchers
+(plan, fetch, concat, prices, align_prices, to_frame) and the errors of the jobs that failed.
+The fetchers return one with their DataFrame when called with report=True. A FetchReport added to the hooks of
+a long-lived client aggregates all its fetches, and can be scraped by Prometheus (see start_metrics_server()).
+
+    - summary(): DataFrame of the counters, one row per instrument, the slowest first
+    - totals(): dict of the counters of all instruments
+    - stages: dict {stage: seconds}, errors: list of (tags, message)
+    - to_dict(): the whole report, JSON serializable
+    - to_prometheus(): the report in the Prometheus text exposition format
+
+EXAMPLE
+    df, report = assets_depth(apikey, start_time, end_time, ['btc', 'eth'], 'spot', '1m', report=True)
+    print(report.stages)
+    print(report.summary().head(10))
+'''
+class FetchReport:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instruments = {}
+        self.stages = {}
+        self.errors = []
+        self._latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._latency_sum = 0.0
+
+    def _counters(self, tags):
+        # counters of an instrument, the caller holds the lock
+        key = tuple(tags.items())
+        if key not in self._instruments:
+            self._instruments[key] = dict.fromkeys(_REPORT_COUNTERS, 0)
+        return self._instruments[key]
+
+    def __call__(self, event, data):
+        with self._lock:
+            if event == 'stage':
+                self.stages[data['stage']] = self.stages.get(data['stage'], 0.0) + data['seconds']
+                return
+            counters = self._counters(data['tags'])
+            if event == 'request':
+                failed = data['status'] is None or data['status'] >= 400
+                counters['pages'] += not failed
+                counters['requests'] += data['attempts']
+                counters['retries'] += data['attempts'] - 1
+                counters['request_errors'] += failed
+                counters['bytes'] += data['bytes']
+                counters['wire_bytes'] += data['wire_bytes']
+                counters['request_seconds'] += data['seconds']
+                counters['latency_seconds'] += data['latency']
+                counters['wait_seconds'] += data['wait']
+                counters['retry_wait_seconds'] += data['retry_wait']
+                counters['decode_seconds'] += data['decode']
+                self._latencies[int(np.searchsorted(LATENCY_BUCKETS, data['latency']))] += 1
+                self._latency_sum += data['latency']
+            elif event == 'job':
+                counters['jobs'] += 1
+                counters['records'] += data['records']
+                counters['job_seconds'] += data['seconds']
+                counters['build_seconds'] += data['build']
+                if data['error'] is not None:
+                    counters['job_failures'] += 1
+                    self.errors.append((dict(data['tags']), data['error']))
+            elif event == 'cache':
+                counters['cache_hits' if data['hit'] else 'cache_misses'] += 1
+                counters['cached_records'] += data['cached']
+
+    def summary(self):
+        with self._lock:
+            rows = [{**dict(key), **counters} for key, counters in self._instruments.items()]
+        if not rows:
+            return pd.DataFrame(columns=list(_REPORT_COUNTERS))
+        summary = pd.DataFrame(rows)
+        tags = [column for column in summary.columns if column not in _REPORT_COUNTERS]
+        return summary[tags + list(_REPORT_COUNTERS)].sort_values('job_seconds', ascending=False, ignore_index=True)
+
+    def totals(self):
+        with self._lock:
+            return {name: sum(counters[name] for counters in self._instruments.values()) for name in _REPORT_COUNTERS}
+
+    def to_dict(self):
+        summary = self.summary()
+        with self._lock:
+            stages, errors = dict(self.stages), [{'tags': tags, 'error': error} for tags, error in self.errors]
+        return {'totals': self.totals(), 'stages': stages, 'errors': errors,
+                'instruments': json.loads(summary.to_json(orient='records'))}
+
+    def to_prometheus(self, prefix='kaiko_depth'):
+        with self._lock:
+            instruments = [(dict(key), dict(counters)) for key, counters in self._instruments.items()]
+            stages, latencies, latency_sum = dict(self.stages), list(self._latencies), self._latency_sum
+        lines = []
+        for name, description in _REPORT_COUNTERS.items():
+            lines += [f'# HELP {prefix}_{name}_total {description}', f'# TYPE {prefix}_{name}_total counter']
+            lines += [f'{prefix}_{name}_total{_prometheus_labels(tags)} {_prometheus_value(counters[name])}' for tags, counters in instruments]
+        lines += [f'# HELP {prefix}_stage_seconds_total time spent in each stage of the fetchers', f'# TYPE {prefix}_stage_seconds_total counter']
+        lines += [f'{prefix}_stage_seconds_total{_prometheus_labels({"stage": stage})} {_prometheus_value(seconds)}' for stage, seconds in stages.items()]
+        lines += [f'# HELP {prefix}_request_latency_seconds latency of the requests (download included)', f'# TYPE {prefix}_request_latency_seconds histogram']
+        for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], np.cumsum(latencies)):
+            lines.append(f'{prefix}_request_latency_seconds_bucket{_prometheus_labels({"le": bound})} {_prometheus_value(count)}')
+        lines += [f'{prefix}_request_latency_seconds_sum {_prometheus_value(latency_sum)}', f'{prefix}_request_latency_seconds_count {_prometheus_value(sum(latencies))}']
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def _stage(client, name):
+    # time a stage of a fetcher, reported to the hooks of the client
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        client.emit('stage', stage=name, seconds=time.perf_counter() - started, tags={})
+
+
+def _reporting(client, report):
+    # when a fetcher is called with report=True, its client also reports to a new FetchReport
+    if not report:
+        return client, None
+    fetch_report = FetchReport()
+    return client.traced(fetch_report), fetch_report
+
+
+'''
+The start_metrics_server() function serves a FetchReport in the Prometheus text format (on any path, e.g. /metrics)
+from a background thread, and returns the server (call its shutdown() method to stop it).
+
+PARAMETERS
+    - report (FetchReport): A required parameter that specifies the report to serve, usually one of the hooks of a long-lived client.
+    - port (int): An optional parameter that specifies the port to listen on. The default value is 9108.
+    - host (string): An optional parameter that specifies the interface to listen on. The default value is "127.0.0.1".
+
+EXAMPLE
+    report = FetchReport()
+    client = KaikoClient(apikey, hooks=[report])
+    server = start_metrics_server(report)
+    tail = DepthTail(apikey, ['btc', 'eth'], '1m', start_time='2023-02-05T00:00:00Z', client=client)
+'''
+def start_metrics_server(report, port=9108, host='127.0.0.1', prefix='kaiko_depth'):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = report.to_prometheus(prefix).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Depth container
+
+'''
+The DepthBlock class is the compact columnar representation of order book snapshots used by the fetchers.
+The depth levels are parsed once, when the snapshots are received, into a single NumPy block:
+    - volumes: float array of shape (snapshots, 16 levels, 2 sides), side 0 is bid and side 1 is ask,
+      levels are in the order of DEPTH_LEVELS
+    - timestamps: int64 array of the poll_timestamp of each snapshot (ms)
+    - keys: dict of categorical columns identifying the instrument of each snapshot (e.g. exchange, pair)
+    - extras: dict of the other columns returned by the API (e.g. mid_price, spread)
+The to_frame() method returns the usual DataFrame view of the snapshots, the instrument columns as strings as the
+fetchers always returned them (categorical=True keeps them categorical, lighter for large frames).
+'''
+class DepthBlock:
+    def __init__(self, volumes, timestamps, keys=None, extras=None, columns=None):
+        self.volumes = volumes
+        self.timestamps = timestamps
+        self.keys = keys if keys is not None else {}
+        self.extras = extras if extras is not None else {}
+        # column order of the API records, used by to_frame()
+        self.columns = columns if columns is not None else ['poll_timestamp'] + DEPTH_COLUMNS + list(self.extras)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def nbytes(self):
+        size = self.volumes.nbytes + self.timestamps.nbytes
+        size += sum(np.asarray(values).nbytes for values in self.extras.values())
+        size += sum(values.codes.nbytes for values in self.keys.values())
+        return size
+
+    @staticmethod
+    def _ladder(depth, dtype):
+        # (n, 32) columns in the order of DEPTH_COLUMNS -> (n, 16, 2), the strings of the API are parsed
+        depth = np.asarray(depth)
+        values = pd.to_numeric(depth.ravel(), errors='coerce') if depth.dtype == object else depth.ravel()
+        return np.ascontiguousarray(values.reshape(-1, 2, len(DEPTH_LEVELS)).transpose(0, 2, 1), dtype=dtype)
+
+    @staticmethod
+    def _extra(values):
+        try:
+            return pd.to_numeric(values).to_numpy()
+        except (ValueError, TypeError):
+            return values.to_numpy()
+
+    '''
+    The from_records() method builds a DepthBlock from the raw records of the API, tags being the
+    instrument keys shared by all the records (e.g. {'pair': 'btc-usd', 'exchange': 'cbse'}).
+    '''
+    @classmethod
+    def from_records(cls, records, tags={}, dtype=np.float64):
+        raw = pd.DataFrame(records, columns=list(records[0]) if records else ['poll_timestamp'])
+        n = len(raw)
+        volumes = cls._ladder(raw.reindex(columns=DEPTH_COLUMNS).to_numpy(dtype=object), dtype)
+        timestamps = raw['poll_timestamp'].to_numpy(dtype=np.int64)
+        keys = {column: pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), [value]) for column, value in tags.items()}
+        extras = {column: cls._extra(raw[column]) for column in raw.columns
+                  if column != 'poll_timestamp' and column not in DEPTH_COLUMNS}
+        columns = list(raw.columns) if records else None
+        return cls(volumes, timestamps, keys, extras, columns)
+
+    '''
+    The from_frame() method builds a DepthBlock from a DataFrame returned by one of the fetchers.
+    '''
+    @classmethod
+    def from_frame(cls, df, dtype=np.float64):
+        volumes = cls._ladder(df.reindex(columns=DEPTH_COLUMNS).to_numpy(), dtype)
+        timestamps = df['poll_timestamp'].to_numpy(dtype=np.int64)
+        keys = {column: pd.Categorical(df[column]) for column in INSTRUMENT_KEYS if column in df}
+        extras = {column: cls._extra(df[column]) for column in df.columns
+                  if column not in DEPTH_COLUMNS and column not in keys and column not in ('poll_timestamp', 'poll_date', 'label')}
+        columns = [column for column in df.columns if column not in keys and column not in ('poll_date', 'label')]
+        return cls(volumes, timestamps, keys, extras, columns)
+
+    '''
+    The concat() method concatenates a list of DepthBlock, the keys stay categorical.
+    '''
+    @classmethod
+    def concat(cls, blocks):
+        blocks = [block for block in blocks if block is not None]
+        if not blocks:
+            raise ValueError('No objects to concatenate')
+        columns = next((block.columns for block in blocks if len(block)), blocks[0].columns)
+        volumes = np.concatenate([block.volumes for block in blocks])
+        timestamps = np.concatenate([block.timestamps for block in blocks])
+        keys = {}
+        for column in dict.fromkeys(column for block in blocks for column in block.keys):
+            parts = [block.keys[column] if column in block.keys else pd.Categorical([None] * len(block)) for block in blocks]
+            keys[column] = union_categoricals(parts)
+        extras = {}
+        for column in dict.fromkeys(column for block in blocks for column in block.extras):
+            extras[column] = np.concatenate([block.extras[column] if column in block.extras else np.full(len(block), np.nan)
+                                             for block in blocks])
+        return cls(volumes, timestamps, keys, extras, columns)
+
+    '''
+    The in_usd() method returns the volumes in USD, a single broadcast multiply by the price of each snapshot
+    (the price_usd extra by default).
+    '''
+    def in_usd(self, price=None):
+        price = self.extras['price_usd'] if price is None else price
+        return self.volumes * np.asarray(price, dtype=self.volumes.dtype)[:, None, None]
+
+    def to_frame(self, categorical=False):
+        n = len(self)
+        depth = self.volumes.transpose(0, 2, 1).reshape(n, len(DEPTH_COLUMNS))
+        data = {}
+        for column in self.columns:
+            if column == 'poll_timestamp':
+                data[column] = self.timestamps
+            elif column in DEPTH_COLUMNS:
+                data[column] = depth[:, DEPTH_COLUMNS.index(column)]
+            elif column in self.extras:
+                data[column] = self.extras[column]
+        # columns added after ingestion (e.g. price_usd)
+        data.update((column, values) for column, values in self.extras.items() if column not in data)
+        data.update(self.keys if categorical else {column: np.asarray(values, dtype=object) for column, values in self.keys.items()})
+        data['poll_date'] = pd.to_datetime(self.timestamps, unit='ms')
+        return pd.DataFrame(data)
+
+
+def _to_numeric(df, columns):
+    # Convert the columns that are not numeric yet (e.g. a DataFrame read from a file)
+    for column in columns:
+        if not pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+
+# Snapshot cache
+
+DAY_MS = 86400000
+_INTERVAL_UNITS_MS = {'s': 1000, 'm': 60000, 'h': 3600000, 'd': DAY_MS}
+
+
+def _to_ms(timestamp):
+    return pd.Timestamp(timestamp).value // 1000000
+
+
+def _to_iso(ms):
+    return pd.Timestamp(ms, unit='ms').strftime('%Y-%m-%dT%H:%M:%S.') + f'{ms % 1000:03d}Z'
+
+
+def _interval_ms(interval):
+    return int(interval[:-1]) * _INTERVAL_UNITS_MS[interval[-1]]
+
+
+def _merge_ranges(ranges):
+    # Merge overlapping or adjacent [start, end) ranges
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+
+def _subtract_ranges(start, end, ranges):
+    # Parts of [start, end) not covered by ranges
+    missing = []
+    for covered_start, covered_end in _merge_ranges(ranges):
+        if covered_end <= start or covered_start >= end:
+            continue
+        if covered_start > start:
+            missing.append((start, covered_start))
+        start = max(start, covered_end)
+    if start < end:
+        missing.append((start, end))
+    return missing
+
+
+'''
+The SnapshotCache class is a persistent on-disk cache (SQLite) of the order book snapshots returned by the API.
+Snapshots are partitioned by (exchange, instrument class, instrument, interval, day), and each partition
+remembers the time ranges it covers, so that a request only downloads what is missing from the cache.
+When the cache grows over max_bytes, the least recently used partitions are evicted.
+
+PARAMETERS
+    - path (string): An optional parameter that specifies the SQLite file of the cache. The default value is "kaiko_depth_cache.sqlite".
+    - max_bytes (int): An optional parameter that specifies the maximum size of the cached snapshots. The default value is 1GB.
+
+EXAMPLE
+    cache = SnapshotCache('depth.sqlite')
+    df = market_depth(apikey, start_time, end_time, 'eth-usd', ['cbse', 'krkn'], '1m', cache=cache)
+'''
+class SnapshotCache:
+    def __init__(self, path='kaiko_depth_cache.sqlite', max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS partitions (key TEXT, day INTEGER, coverage TEXT, bytes INTEGER, '
+                             'last_access REAL, PRIMARY KEY (key, day))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS snapshots (key TEXT, day INTEGER, poll_timestamp INTEGER, record TEXT, '
+                             'PRIMARY KEY (key, poll_timestamp))')
+
+    @staticmethod
+    def _key(job):
+        return '/'.join([job.exchange, job.instrument_class, job.instrument, job.interval])
+
+    def _coverage(self, key, day):
+        row = self._db.execute('SELECT coverage FROM partitions WHERE key = ? AND day = ?', (key, day)).fetchone()
+        return [tuple(r) for r in json.loads(row[0])] if row else []
+
+    def missing_ranges(self, job):
+        # Time ranges [start, end) of the job's window that are not in the cache
+        key = self._key(job)
+        start, end = _to_ms(job.start_time), _to_ms(job.end_time) + 1
+        missing = []
+        with self._lock:
+            for day in range(start // DAY_MS, (end - 1) // DAY_MS + 1):
+                day_start, day_end = max(start, day * DAY_MS), min(end, (day + 1) * DAY_MS)
+                missing += _subtract_ranges(day_start, day_end, self._coverage(key, day))
+        return _merge_ranges(missing)
+
+    '''
+    The store() method stores the raw snapshots downloaded for the time range [start, end) (ms) of a DepthJob, replacing
+    the ones already stored in that range, and marks the range as covered (except the last interval before now,
+    whose snapshots may not be published yet).
+    '''
+    def store(self, job, start, end, records):
+        key = self._key(job)
+        # Snapshots close to now may not be published yet, they are not marked as covered
+        covered_end = min(end, int(time.time() * 1000) - _interval_ms(job.interval))
+        by_day = {}
+        for record in records:
+            by_day.setdefault(record['poll_timestamp'] // DAY_MS, []).append(record)
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM snapshots WHERE key = ? AND poll_timestamp >= ? AND poll_timestamp < ?', (key, start, end))
+            for day in range(start // DAY_MS, (end - 1) // DAY_MS + 1):
+                rows = [(key, day, r['poll_timestamp'], json.dumps(r)) for r in by_day.get(day, [])]
+                self._db.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)', rows)
+                coverage = self._coverage(key, day)
+                day_start, day_end = max(start, day * DAY_MS), min(covered_end, (day + 1) * DAY_MS)
+                if day_start < day_end:
+                    coverage = _merge_ranges(coverage + [(day_start, day_end)])
+                size = self._db.execute('SELECT COALESCE(SUM(LENGTH(record)), 0) FROM snapshots WHERE key = ? AND day = ?',
+                                        (key, day)).fetchone()[0]
+                self._db.execute('INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?, ?)',
+                                 (key, day, json.dumps(coverage), size, time.time()))
+
+    '''
+    The read() method returns the stored snapshots of the window of a DepthJob, newest first as the API does.
+    '''
+    def read(self, job):
+        key = self._key(job)
+        start, end = _to_ms(job.start_time), _to_ms(job.end_time) + 1
+        with self._lock, self._db:
+            self._db.execute('UPDATE partitions SET last_access = ? WHERE key = ? AND day >= ? AND day <= ?',
+                             (time.time(), key, start // DAY_MS, (end - 1) // DAY_MS))
+            rows = self._db.execute('SELECT record FROM snapshots WHERE key = ? AND poll_timestamp >= ? AND poll_timestamp < ? '
+                                    'ORDER BY poll_timestamp DESC', (key, start, end)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def evict(self):
+        # Drop the least recently used partitions until the cache fits in max_bytes
+        with self._lock, self._db:
+            total = self._db.execute('SELECT COALESCE(SUM(bytes), 0) FROM partitions').fetchone()[0]
+            for key, day, size in self._db.execute('SELECT key, day, bytes FROM partitions ORDER BY last_access').fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._db.execute('DELETE FROM snapshots WHERE key = ? AND day = ?', (key, day))
+                self._db.execute('DELETE FROM partitions WHERE key = ? AND day = ?', (key, day))
+                total -= size
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM snapshots')
+            self._db.execute('DELETE FROM partitions')
+
+
+# Request planning
+
+# Local copy of the instruments reference data, refreshed when older than DEFAULT_INSTRUMENTS_MAX_AGE seconds
+DEFAULT_INSTRUMENTS_FILE = 'kaiko_instruments.json'
+DEFAULT_INSTRUMENTS_MAX_AGE = 86400
+
+# Number of snapshots per page of the ob_aggregations endpoint, used to estimate the number of pages of a plan
+DEFAULT_PAGE_SIZE = 100
+
+
+def _download_instruments(client):
+    instruments = []
+    for instrument in client.get_json(client.reference_url)['data']:
+        start, end = instrument.get('trade_start_time'), instrument.get('trade_end_time')
+        instruments.append([instrument['exchange_code'], instrument['class'], instrument['code'],
+                            _to_ms(start) if start else None, _to_ms(end) if end else None])
+    return instruments
+
+
+'''
+The load_instruments() function returns the instruments listed by Kaiko, as a dict
+{(exchange, instrument_class, instrument): (trade_start_ms, trade_end_ms)}, a None bound meaning no limit.
+The reference data is downloaded once and kept in a local file (only the fields used by the planner), which is
+downloaded again when it is older than max_age seconds.
+
+PARAMETERS
+    - path (string): An optional parameter that specifies the local file of the instruments. The default value is "kaiko_instruments.json".
+    - max_age (int): An optional parameter that specifies the maximum age (seconds) of the local file. The default value is 86400 (1 day).
+    - client (KaikoClient): An optional parameter that specifies the client used to download the reference data. The default value is None (a new client).
+'''
+def load_instruments(path=DEFAULT_INSTRUMENTS_FILE, max_age=DEFAULT_INSTRUMENTS_MAX_AGE, client=None):
+    if not os.path.exists(path) or time.time() - os.path.getmtime(path) > max_age:
+        instruments = _download_instruments(client or KaikoClient(None))
+        with open(path, 'w') as f:
+            json.dump(instruments, f)
+    else:
+        with open(path) as f:
+            instruments = json.load(f)
+    return {(exchange, instrument_class, code): (start, end) for exchange, instrument_class, code, start, end in instruments}
+
+
+'''
+A DepthPlan is the minimal list of DepthJob to fetch, with:
+    - requests: the number of instruments to request (one paginated request each)
+    - pages: the estimated number of pages (API calls), page_size snapshots per page
+    - duplicates: the number of duplicate jobs removed
+    - unlisted: the jobs removed because the instrument isn't listed, or wasn't trading during the window
+'''
+DepthPlan = namedtuple('DepthPlan', ['jobs', 'requests', 'pages', 'duplicates', 'unlisted'])
+
+
+'''
+The plan_depth() function builds the DepthPlan of a list of DepthJob: duplicate jobs (same instrument, window and
+interval) are collapsed, and the jobs of instruments that are not listed in the instruments reference data (see
+load_instruments()) are pruned before any request is sent. If the reference data can't be loaded, nothing is pruned.
+
+PARAMETERS
+    - jobs (list of DepthJob): A required parameter that specifies the candidate jobs.
+    - instruments_file (string): An optional parameter that specifies the local file of the instruments reference data.
+      The default value is "kaiko_instruments.json". Use None to skip the pruning.
+    - page_size (int): An optional parameter that specifies the number of snapshots per page, for the estimate. The default value is 100.
+    - client (KaikoClient): An optional parameter that specifies the client used to download the reference data. The default value is None (a new client).
+'''
+def plan_depth(jobs, instruments_file=DEFAULT_INSTRUMENTS_FILE, page_size=DEFAULT_PAGE_SIZE, client=None):
+    instruments = None
+    if instruments_file is not None:
+        try:
+            instruments = load_instruments(instruments_file, client=client)
+        except Exception:
+            print('instruments reference data not available, the requests are not pruned')
+    planned, unlisted, seen = [], [], set()
+    pages = 0
+    for job in jobs:
+        key = (job.exchange, job.instrument_class, job.instrument, job.start_time, job.end_time, job.interval)
+        if key in seen:
+            continue
+        seen.add(key)
+        start, end = _to_ms(job.start_time), _to_ms(job.end_time)
+        if instruments is not None:
+            listing = instruments.get((job.exchange, job.instrument_class, job.instrument))
+            if listing is None or (listing[0] is not None and listing[0] > end) or (listing[1] is not None and listing[1] < start):
+                unlisted.append(job)
+                continue
+            start = max(start, listing[0] or start)
+            end = min(end, listing[1] or end)
+        snapshots = (end - start) // _interval_ms(job.interval) + 1
+        pages += max(1, -(-snapshots // page_size))
+        planned.append(job)
+    return DepthPlan(planned, len(planned), pages, len(jobs) - len(seen), unlisted)
+
+
+# Charts
+
+# matplotlib is only imported by the chart functions, with this backend if pyplot isn't imported yet: a non-interactive
+# one, the charts are saved to files. A backend chosen beforehand (pyplot imported first, or the MPLBACKEND variable
+# set by Jupyter for inline charts) is kept. Use None to let matplotlib choose (e.g. windows opened by show=True).
+PLOT_BACKEND = 'Agg'
+
+# Backends that can't display a figure: the figures drawn with them are closed once saved, instead of piling up
+_NON_INTERACTIVE_BACKENDS = ('agg', 'cairo', 'pdf', 'pgf', 'ps', 'svg', 'template')
+
+
+def _pyplot():
+    import matplotlib
+    if PLOT_BACKEND and 'matplotlib.pyplot' not in sys.modules and not os.environ.get('MPLBACKEND'):
+        matplotlib.use(PLOT_BACKEND)
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def _show(fig, file_name=None, show=False):
+    # Save and/or show a figure drawn by one of the chart functions
+    plt = _pyplot()
+    if file_name:
+        fig.savefig(file_name, format='jpeg')
+    if show:
+        plt.show()
+    if plt.get_backend().lower() in _NON_INTERACTIVE_BACKENDS:
+        plt.close(fig)
+
+
+# Titles of the heatmaps, by grouping: exchange-pair label (market_heatmap), exchange (asset_heatmap), base (assets_heatmap)
+HEATMAP_TITLES = {'label': "market depth by pair & exchange\n",
+                  'exchange': "Selected asset's market depth by exchange\n",
+                  'base': "Assets Market Depth\n"}
+
+
+def _heatmap_means(df, by):
+    # Average depths drawn by the heatmaps: by label (market_heatmap), exchange (asset_heatmap) or base in USD (assets_heatmap)
+    usd = by == 'base'
+    if isinstance(df, (DepthDataset, DepthRollup)):
+        return df.group_means(by, usd=usd)
+    if by == 'label':
+        # Combine the exchange and pair columns to create a new label column
+        df['label'] = df['exchange'].astype(str) + '-' + df['pair'].astype(str)
+    # convert columns to numeric
+    df = _to_numeric(df, DEPTH_COLUMNS)
+    # multiply the depth columns with the USD price of the base
+    depth = _usd_depth(df) if usd else df[DEPTH_COLUMNS]
+    # group and compute the mean of the depth columns
+    return depth.groupby(df[by], observed=True).mean()
+
+
+'''
+The _plot_heatmap() function draws the heatmap shared by the heatmap functions on a figure, from a DataFrame
+of mean depths (one row per group, one column per depth level).
+'''
+def _plot_heatmap(fig, df, title):
+    # Transpose the dataframe
+    df = df.T
+    # Create an axis
+    ax = fig.subplots()
+    # Create a heatmap of the dataframe values
+    im = ax.imshow(df, cmap='YlGnBu')
+    # Add a colorbar
+    fig.colorbar(im)
+    # Add labels to the x and y axis
+    ax.set_xticks(range(df.shape[1]))
+    ax.set_yticks(range(df.shape[0]))
+    ax.set_xticklabels(df.columns)
+    ax.set_yticklabels(df.index)
+    # Add a title to the heatmap
+    ax.set_title(title)
+    # Rotate the x-axis labels
+    ax.tick_params(axis='x', labelrotation=70)
+
+
+def _draw_heatmap(df, title, file_name=None, show=False):
+    fig = _pyplot().figure(figsize=(10, 8))
+    _plot_heatmap(fig, df, title)
+    _show(fig, file_name, show)
+
+
+# Rollups
+
+'''
+The DepthRollup class is a pre-aggregated index of the depth columns: it keeps the sums and counts of the depths by
+(base, exchange, pair, time bucket), for each bucket size (hourly and daily by default), updated batch after batch.
+The average depths over a time range, grouped by base, exchange, pair or label (exchange-pair), are computed from
+the buckets instead of the snapshots: rendering several views of a long history scales with the number of buckets.
+The base is derived from the pair (as create_json() does) since the USD conversion drops the base column.
+
+A time range is rounded inward to the buckets of the smallest size (a bucket is counted when it is entirely within
+the range), and the larger buckets are used for the part of the range they entirely cover.
+A DepthRollup can be passed instead of a DataFrame to the heatmap functions and to create_json().
+
+PARAMETERS
+    - resolutions (list of strings): An optional parameter that specifies the sizes of the time buckets, each one a multiple of the previous one.
+      The default value is ['1h', '1d']. Use [] to only keep the totals by instrument (no time range).
+
+EXAMPLE
+    rollup = DepthRollup.from_frame(assets_depth(apikey, start_time, end_time, ['btc', 'eth'], 'spot', '1m'))
+    assets_heatmap(rollup, 'assets_heat.jpeg')
+    assets_heatmap(rollup.between('2023-02-06T00:00:00Z', '2023-02-07T00:00:00Z'), 'assets_heat_0206.jpeg')
+    create_json(rollup, 'depth_results.json', usd=True)
+'''
+class DepthRollup:
+    def __init__(self, resolutions=['1h', '1d']):
+        self.resolutions = sorted(_interval_ms(resolution) for resolution in resolutions)
+        for smaller, larger in zip(self.resolutions, self.resolutions[1:]):
+            if larger % smaller:
+                raise ValueError(f'each bucket size must be a multiple of the previous one: {resolutions}')
+        # time range of the view returned by between()
+        self._range = (None, None)
+        self._lock = threading.Lock()
+        # {kind: {resolution: (sums, counts)}} merged, and the aggregates of the batches received since the last query
+        self._frames = {}
+        self._pending = {}
+
+    def __getstate__(self):
+        # the lock isn't pickled, e.g. to send a rollup to the workers of render_charts()
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, df, resolutions=['1h', '1d']):
+        rollup = cls(resolutions)
+        rollup.update(df)
+        return rollup
+
+    def update(self, df):
+        pair = df['pair'].astype(str)
+        finest = self.resolutions[0] if self.resolutions else 0
+        timestamps = df['poll_timestamp'].to_numpy(dtype=np.int64) if finest else np.zeros(len(df), dtype=np.int64)
+        keys = [pair.str.split('-').str[0].rename('base'), df['exchange'].astype(str).rename('exchange'), pair.rename('pair'),
+                pd.Series(timestamps - timestamps % finest if finest else timestamps, index=df.index, name='bucket')]
+        values = {'raw': _to_numeric(df[DEPTH_COLUMNS], DEPTH_COLUMNS)}
+        if 'price_usd' in df:
+            values['usd'] = _usd_depth(df)
+        for kind, depth in values.items():
+            sums = depth.groupby(keys).sum()
+            counts = depth.notna().groupby(keys).sum()
+            with self._lock:
+                pending = self._pending.setdefault(kind, {})
+                for resolution in self.resolutions or [0]:
+                    if resolution != finest:
+                        # the larger buckets are aggregated from the smaller ones, not from the snapshots
+                        sums, counts = _coarsen(sums, resolution), _coarsen(counts, resolution)
+                    pending.setdefault(resolution, []).append((sums, counts))
+
+    def _merged(self, kind, resolution):
+        # merge the pending aggregates of a bucket size, the caller holds the lock
+        frames = self._frames.setdefault(kind, {})
+        pending = self._pending.get(kind, {}).pop(resolution, [])
+        if pending:
+            parts = ([frames[resolution]] if resolution in frames else []) + pending
+            frames[resolution] = tuple(pd.concat([part[i] for part in parts]).groupby(level=[0, 1, 2, 3]).sum() for i in (0, 1))
+        return frames.get(resolution)
+
+    def _buckets(self, start_time, end_time):
+        # (bucket size, first bucket, last bucket) to read; a single bucket size when there is no time range
+        if start_time is None and end_time is None:
+            return [((self.resolutions or [0])[-1], None, None)]
+        if not self.resolutions:
+            raise ValueError('this rollup has no time buckets, it can only average the whole history')
+        finest = self.resolutions[0]
+
+        def split(first, last, resolutions):
+            # first and last are the first and last buckets of the smallest size in the range
+            if first > last:
+                return []
+            resolution = resolutions[-1]
+            if len(resolutions) == 1:
+                return [(resolution, first, last)]
+            covered_first = -(-first // resolution) * resolution
+            covered_last = (last + finest) // resolution * resolution - resolution
+            if covered_first > covered_last:
+                return split(first, last, resolutions[:-1])
+            return (split(first, covered_first - finest, resolutions[:-1]) + [(resolution, covered_first, covered_last)]
+                    + split(covered_last + resolution, last, resolutions[:-1]))
+
+        first = -(-_to_ms(start_time) // finest) * finest if start_time is not None else -(1 << 62)
+        last = (_to_ms(end_time) + 1) // finest * finest - finest if end_time is not None else 1 << 62
+        return split(first, last, self.resolutions)
+
+    '''
+    The between() method returns a view of the rollup restricted to a time range (UTC, ISO 8601), that can be passed
+    to the heatmap functions and to create_json(). The view follows the updates of the rollup.
+    '''
+    def between(self, start_time=None, end_time=None):
+        view = copy.copy(self)
+        view._range = (start_time, end_time)
+        return view
+
+    '''
+    The group_means() method returns the average depths grouped by 'base', 'exchange', 'pair' or 'label' (exchange-pair),
+    over the time range of the view (or from start_time to end_time). With usd=True the depths are expressed in USD.
+    '''
+    def group_means(self, by='base', usd=False, start_time=None, end_time=None):
+        kind = 'usd' if usd else 'raw'
+        if start_time is None and end_time is None:
+            start_time, end_time = self._range
+        sums, counts = [], []
+        with self._lock:
+            for resolution, first, last in self._buckets(start_time, end_time):
+                frames = self._merged(kind, resolution)
+                if frames is None:
+                    continue
+                if first is None:
+                    sums.append(frames[0])
+                    counts.append(frames[1])
+                else:
+                    buckets = frames[0].index.get_level_values('bucket')
+                    selected = (buckets >= first) & (buckets <= last)
+                    sums.append(frames[0][selected])
+                    counts.append(frames[1][selected])
+        if not sums:
+            return pd.DataFrame(columns=DEPTH_COLUMNS)
+        sums, counts = pd.concat(sums), pd.concat(counts)
+        if by == 'label':
+            labels = sums.index.get_level_values('exchange') + '-' + sums.index.get_level_values('pair')
+            sums, counts = sums.groupby(labels).sum(), counts.groupby(labels).sum()
+        else:
+            sums, counts = sums.groupby(level=by).sum(), counts.groupby(level=by).sum()
+        return sums / counts.where(counts > 0)
+
+
+def _coarsen(frame, resolution):
+    # aggregate the buckets of a rollup frame into larger buckets
+    index = frame.index
+    buckets = index.get_level_values('bucket')
+    return frame.groupby([index.get_level_values(level) for level in ('base', 'exchange', 'pair')] + [buckets - buckets % resolution]).sum()
+
 
 # Instrument Level
 
@@ -21,30 +1280,26 @@ You can get your API token by filling the form on this page https://www.kaiko.co
 The market depth data is available for a month history (rolling)
     - start_time (string): A required parameter that specifies the start time of the data query in UTC. The format should be in ISO 8601 (e.g. "2022-01-01T00:00:00Z").
     - end_time (string): A required parameter that specifies the end time of the data query in UTC. The format should be in ISO 8601 (e.g. "2022-01-02T00:00:00Z").
+The requests are sent concurrently by the fetch engine (see fetch_depth()), the output is the same as if they were sent one by one
+    - max_workers (int): An optional parameter that specifies the maximum number of requests in flight. The default value is 8.
+    - rate_limit (float): An optional parameter that specifies the maximum number of requests per second sent to the API. The default value is 10.
+    - client (KaikoClient): An optional parameter that specifies the HTTP client to use (retries, timeouts, API url). The default value is None (a client is created from apikey and rate_limit).
+    - cache (SnapshotCache): An optional parameter that specifies an on-disk cache of the snapshots, only the time ranges missing from the cache are downloaded. The default value is None (no cache).
+    - refresh (bool): An optional parameter that bypasses the cached snapshots and downloads the whole window again. The default value is False.
+    - report (bool): An optional parameter that also returns a FetchReport of the call (requests, pages, bytes, latency, retries and stage timings by instrument), as (df, report). The default value is False.
 '''
-def market_depth(apikey, start_time, end_time, instrument, exchanges, interval, instrument_class='spot'):
-    headers = {'Accept': 'application/json',
-               'X-Api-Key': apikey}
-    df_list = []
+def market_depth(apikey, start_time, end_time, instrument, exchanges, interval, instrument_class='spot', max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, cache=None, refresh=False, client=None, report=False):
+    client, fetch_report = _reporting(client or KaikoClient(apikey, rate_limit=rate_limit), report)
+    jobs = []
     for exchange in exchanges:
-        try:
-            url = f'https://us.market-api.kaiko.io/v2/data/order_book_snapshots.v1/exchanges/{exchange}/{instrument_class}/{instrument}/ob_aggregations/full?start_time={start_time}&end_time={end_time}&interval={interval}'
-            res = requests.get(url, headers=headers)
-            df = pd.DataFrame(res.json()['data'])
-            df['pair'] = (instrument)
-            df['exchange'] = (exchange)
-            while 'next_url' in res.json():
-                res = requests.get(res.json()['next_url'], headers=headers)
-                data =  pd.DataFrame(res.json()['data'])
-                data['pair'] = (instrument)
-                data['exchange'] = (exchange)
-                df = pd.concat([df,data], ignore_index=True)
-        except:
-            print('not available: ' + str(exchange) + ' / ' +str(instrument))
-        df_list.append(df)
-    final_df = pd.concat(df_list)
-    final_df['poll_date'] = pd.to_datetime(final_df['poll_timestamp'], unit='ms')
-    return final_df
+        jobs.append(DepthJob(exchange, instrument_class, instrument, start_time, end_time, interval, {'pair': instrument, 'exchange': exchange}))
+    with _stage(client, 'fetch'):
+        blocks = fetch_depth(client, jobs, max_workers, cache=cache, refresh=refresh)
+    with _stage(client, 'concat'):
+        block = DepthBlock.concat(blocks)
+    with _stage(client, 'to_frame'):
+        final_df = block.to_frame()
+    return (final_df, fetch_report) if report else final_df
 
 
 '''
@@ -53,70 +1308,36 @@ at a selected level (using the parameter "values"), across the exchanges initial
 It uses the data returned using the market_depth() function.
 '''
 def market_depth_chart(df, values, file_name=None, show=False):
+    fig = _pyplot().figure(figsize=(10, 6))
+    _plot_market_depth_chart(fig, df, values)
+    _show(fig, file_name, show)
+
+
+def _plot_market_depth_chart(fig, df, values):
+    if isinstance(df, DepthDataset):
+        df = df.to_frame(columns=['poll_date', 'exchange', 'pair', values])
     # Combine the exchange and pair columns to create a new label column
-    df['label'] = df['exchange'] + '-' + df['pair']
+    df['label'] = df['exchange'].astype(str) + '-' + df['pair'].astype(str)
     # Pivot the dataframe to aggregate the 'values'
     pivot_df = df.pivot_table(values=values, index='poll_date', columns='label')
     # Interpolate missing values
     pivot_df.interpolate(method='linear', axis=0, inplace=True)
-    # Create a new figure and axis
-    plt.figure(figsize=(10,6))
-    ax = plt.gca()
+    # Create a new axis
+    ax = fig.subplots()
     # Plot the line chart
     pivot_df.plot(ax=ax)
     # Add title and labels
-    plt.title(values.capitalize() + " depth by pair & exchange")
-    plt.xlabel("Date")
-    plt.ylabel(values)
-    plt.xticks(rotation=60)
-    plt.legend()
-    if file_name:
-        plt.savefig(file_name, format="jpeg")
-    if show:
-        # Show the chart
-        plt.show()
+    ax.set_title(values.capitalize() + " depth by pair & exchange")
+    ax.set_xlabel("Date")
+    ax.set_ylabel(values)
+    ax.tick_params(axis='x', labelrotation=60)
+    ax.legend()
 
 '''
-The market_heatmap() function creates a heatmap based on the data returned by the market_depth() function
-'''
-def market_heatmap(df, file_name=None, show=False):
-    # Combine the exchange and pair columns to create a new label column
-    df['label'] = df['exchange'] + '-' + df['pair']
-    cols = ['bid_volume0_1','bid_volume0_2', 'bid_volume0_3', 'bid_volume0_4', 'bid_volume0_5',
-           'bid_volume0_6', 'bid_volume0_7', 'bid_volume0_8', 'bid_volume0_9',
-           'bid_volume1', 'bid_volume1_5', 'bid_volume2', 'bid_volume4',
-           'bid_volume6', 'bid_volume8', 'bid_volume10', 'ask_volume0_1',
-           'ask_volume0_2', 'ask_volume0_3', 'ask_volume0_4', 'ask_volume0_5',
-           'ask_volume0_6', 'ask_volume0_7', 'ask_volume0_8', 'ask_volume0_9',
-           'ask_volume1', 'ask_volume1_5', 'ask_volume2', 'ask_volume4',
-           'ask_volume6', 'ask_volume8', 'ask_volume10']
-    # convert columns to numeric
-    df[cols] = df[cols].apply(pd.to_numeric, errors='coerce')
-    # group by exchange and compute the mean
-    df = df.groupby('label')[cols].mean()
-    # Transpose the dataframe
-    df = df.T
-    # Create a figure and axis
-    fig, ax = plt.subplots(figsize=(10, 8))
-    # Create a heatmap of the dataframe values
-    im = ax.imshow(df, cmap='YlGnBu')
-    # Add a colorbar
-    fig.colorbar(im)
-    # Add labels to the x and y axis
-    ax.set_xticks(range(df.shape[1]))
-    ax.set_yticks(range(df.shape[0]))
-    ax.set_xticklabels(df.columns)
-    ax.set_yticklabels(df.index)
-    # Add a title to the heatmap
-    plt.title("market depth by pair & exchange\n")
-    # Rotate the x-axis labels
-    plt.xticks(rotation=70)
-    if file_name:
-        # Save the plot
-        plt.savefig(file_name, format='jpeg')
-    if show:
-        # Show the plot
-        plt.show()
+The market_heatmap() function creates a heatmap based on the data returned by the market_depth() function
+'''
+def market_heatmap(df, file_name=None, show=False):
+    _draw_heatmap(_heatmap_means(df, 'label'), HEATMAP_TITLES['label'], file_name, show)
 
 
 
@@ -145,45 +1366,35 @@ You can get your API token by filling the form on this page https://www.kaiko.co
 The market depth data is available for a month history (rolling)
     - start_time (string): A required parameter that specifies the start time of the data query in UTC. The format should be in ISO 8601 (e.g. "2022-01-01T00:00:00Z").
     - end_time (string): A required parameter that specifies the end time of the data query in UTC. The format should be in ISO 8601 (e.g. "2022-01-02T00:00:00Z").
+The requests are sent concurrently by the fetch engine (see fetch_depth()), the output is the same as if they were sent one by one
+    - max_workers (int): An optional parameter that specifies the maximum number of requests in flight. The default value is 8.
+    - rate_limit (float): An optional parameter that specifies the maximum number of requests per second sent to the API. The default value is 10.
+    - client (KaikoClient): An optional parameter that specifies the HTTP client to use (retries, timeouts, API url). The default value is None (a client is created from apikey and rate_limit).
+    - cache (SnapshotCache): An optional parameter that specifies an on-disk cache of the snapshots, only the time ranges missing from the cache are downloaded. The default value is None (no cache).
+    - refresh (bool): An optional parameter that bypasses the cached snapshots and downloads the whole window again. The default value is False.
+The instruments are planned before being requested (see plan_depth()): duplicates are removed, and pairs not listed on an exchange are not requested
+    - instruments_file (string): An optional parameter that specifies the local copy of Kaiko's instruments reference data used to prune the pairs that are not listed. The default value is "kaiko_instruments.json". Use None to request every pair.
+    - dry_run (bool): An optional parameter that returns the DepthPlan (planned requests and estimated number of pages) instead of fetching the data. The default value is False.
+    - report (bool): An optional parameter that also returns a FetchReport of the call (requests, pages, bytes, latency, retries and stage timings by instrument), as (df, report). The default value is False.
 '''
-def asset_depth(apikey, start_time, end_time, base_asset, exchanges, interval, quote_assets=['usd', 'usdt', 'usdc', 'dai', 'busd'], instrument_class='spot'):
-    headers = {'Accept': 'application/json',
-               'X-Api-Key': apikey}
-    df_list = []
+def asset_depth(apikey, start_time, end_time, base_asset, exchanges, interval, quote_assets=['usd', 'usdt', 'usdc', 'dai', 'busd'], instrument_class='spot', max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, cache=None, refresh=False, instruments_file=DEFAULT_INSTRUMENTS_FILE, dry_run=False, client=None, report=False):
+    client, fetch_report = _reporting(client or KaikoClient(apikey, rate_limit=rate_limit), report)
+    jobs = []
     for quote_asset in quote_assets:
         instrument = f"{base_asset}-{quote_asset}"
         for exchange in exchanges:
-            try:
-                url = f'https://us.market-api.kaiko.io/v2/data/order_book_snapshots.v1/exchanges/{exchange}/{instrument_class}/{instrument}/ob_aggregations/full?start_time={start_time}&end_time={end_time}&interval={interval}'
-                res = requests.get(url, headers=headers)
-                df = pd.DataFrame(res.json()['data'])
-                df['pair'] = (instrument)
-                df['exchange'] = (exchange)
-                while 'next_url' in res.json():
-                    res = requests.get(res.json()['next_url'], headers=headers)
-                    data =  pd.DataFrame(res.json()['data'])
-                    data['pair'] = (instrument)
-                    data['exchange'] = (exchange)
-                    df = pd.concat([df,data], ignore_index=True)
-            except:
-                print('no instrument found')
-            df_list.append(df)    
-    final_df = pd.concat(df_list)
-    final_df['poll_date'] = pd.to_datetime(final_df['poll_timestamp'], unit='ms')
-    def convert_to_numeric(df, column_list):
-        for column in column_list:
-            df[column] = pd.to_numeric(df[column], errors='coerce')
-        return df
-    columns_to_convert = ['bid_volume0_1','bid_volume0_2', 'bid_volume0_3', 'bid_volume0_4', 'bid_volume0_5',
-           'bid_volume0_6', 'bid_volume0_7', 'bid_volume0_8', 'bid_volume0_9',
-           'bid_volume1', 'bid_volume1_5', 'bid_volume2', 'bid_volume4',
-           'bid_volume6', 'bid_volume8', 'bid_volume10', 'ask_volume0_1',
-           'ask_volume0_2', 'ask_volume0_3', 'ask_volume0_4', 'ask_volume0_5',
-           'ask_volume0_6', 'ask_volume0_7', 'ask_volume0_8', 'ask_volume0_9',
-           'ask_volume1', 'ask_volume1_5', 'ask_volume2', 'ask_volume4',
-           'ask_volume6', 'ask_volume8', 'ask_volume10']
-    final_df = convert_to_numeric(final_df, columns_to_convert)
-    return final_df
+            jobs.append(DepthJob(exchange, instrument_class, instrument, start_time, end_time, interval, {'pair': instrument, 'exchange': exchange}))
+    with _stage(client, 'plan'):
+        plan = plan_depth(jobs, instruments_file, client=client)
+    if dry_run:
+        return plan
+    with _stage(client, 'fetch'):
+        blocks = fetch_depth(client, plan.jobs, max_workers, cache=cache, refresh=refresh)
+    with _stage(client, 'concat'):
+        block = DepthBlock.concat(blocks)
+    with _stage(client, 'to_frame'):
+        final_df = block.to_frame()
+    return (final_df, fetch_report) if report else final_df
 
 '''
 The asset_depth_chart() function creates a line chart comparing the market depth 
@@ -191,70 +1402,37 @@ at a selected level (using the parameter "values"), across the exchanges initial
 It uses the data returned using the asset_depth() function.
 '''
 def asset_depth_chart(df, values, file_name=None, show=False):
+    fig = _pyplot().figure(figsize=(15, 6))
+    _plot_asset_depth_chart(fig, df, values)
+    _show(fig, file_name, show)
+
+
+def _plot_asset_depth_chart(fig, df, values):
+    if isinstance(df, DepthDataset):
+        df = df.to_frame(columns=['poll_date', 'exchange', values])
     # Pivot the dataframe to aggregate the 'values'
-    pivot_df = df.pivot_table(values=values, index='poll_date', columns='exchange')
+    pivot_df = df.pivot_table(values=values, index='poll_date', columns='exchange', observed=True)
     # Interpolate missing values
     pivot_df.interpolate(method='linear', axis=0, inplace=True)
-    # Create a new figure and axis
-    plt.figure(figsize=(15,6))
-    ax = plt.gca()
+    # Create a new axis
+    ax = fig.subplots()
     # Plot the line chart
     pivot_df.plot(ax=ax)
     # Add the sum line to the chart
-    plt.plot(pivot_df.sum(axis=1), label='Total', color='black')
+    ax.plot(pivot_df.sum(axis=1), label='Total', color='black')
     # Add title and labels
-    plt.title(values.capitalize() + " depth by exchange")
-    plt.xlabel("Date")
-    plt.ylabel(values)
-    plt.xticks(rotation=60)
-    plt.legend()
-    if file_name:
-        plt.savefig(file_name, format='jpeg')
-    if show:
-        # Show the chart
-        plt.show()
+    ax.set_title(values.capitalize() + " depth by exchange")
+    ax.set_xlabel("Date")
+    ax.set_ylabel(values)
+    ax.tick_params(axis='x', labelrotation=60)
+    ax.legend()
 
         
 '''
 The asset_heatmap() function creates a heatmap based on the data returned by the asset_depth() function
 '''
 def asset_heatmap(df, file_name=None, show=False):
-    
-    cols = ['bid_volume0_1','bid_volume0_2', 'bid_volume0_3', 'bid_volume0_4', 'bid_volume0_5',
-           'bid_volume0_6', 'bid_volume0_7', 'bid_volume0_8', 'bid_volume0_9',
-           'bid_volume1', 'bid_volume1_5', 'bid_volume2', 'bid_volume4',
-           'bid_volume6', 'bid_volume8', 'bid_volume10', 'ask_volume0_1',
-           'ask_volume0_2', 'ask_volume0_3', 'ask_volume0_4', 'ask_volume0_5',
-           'ask_volume0_6', 'ask_volume0_7', 'ask_volume0_8', 'ask_volume0_9',
-           'ask_volume1', 'ask_volume1_5', 'ask_volume2', 'ask_volume4',
-           'ask_volume6', 'ask_volume8', 'ask_volume10']
-    # convert columns to numeric
-    df[cols] = df[cols].apply(pd.to_numeric, errors='coerce')
-    # group by exchange and compute the average
-    df = df.groupby('exchange')[cols].mean()
-    # Transpose the dataframe
-    df = df.T
-    # Create a figure and axis
-    fig, ax = plt.subplots(figsize=(10, 8))
-    # Create a heatmap of the dataframe values
-    im = ax.imshow(df, cmap='YlGnBu')
-    # Add a colorbar
-    fig.colorbar(im)
-    # Add labels to the x and y axis
-    ax.set_xticks(range(df.shape[1]))
-    ax.set_yticks(range(df.shape[0]))
-    ax.set_xticklabels(df.columns)
-    ax.set_yticklabels(df.index)
-    # Add a title to the heatmap
-    plt.title("Selected asset's market depth by exchange\n")
-    # Rotate the x-axis labels
-    plt.xticks(rotation=70)
-    if file_name:
-        # Save the plot
-        plt.savefig(file_name, format='jpeg')
-    if show:
-        # Show the plot
-        plt.show()
+    _draw_heatmap(_heatmap_means(df, 'exchange'), HEATMAP_TITLES['exchange'], file_name, show)
 
 
 
@@ -285,146 +1463,1239 @@ You can get your API token by filling the form on this page https://www.kaiko.co
 The market depth data is available for a month history (rolling)
     - start_time (string): A required parameter that specifies the start time of the data query in UTC. The format should be in ISO 8601 (e.g. "2022-01-01T00:00:00Z").
     - end_time (string): A required parameter that specifies the end time of the data query in UTC. The format should be in ISO 8601 (e.g. "2022-01-02T00:00:00Z").
+The requests are sent concurrently by the fetch engine (see fetch_depth()), the output is the same as if they were sent one by one
+    - max_workers (int): An optional parameter that specifies the maximum number of requests in flight. The default value is 8.
+    - rate_limit (float): An optional parameter that specifies the maximum number of requests per second sent to the API. The default value is 10.
+    - client (KaikoClient): An optional parameter that specifies the HTTP client to use (retries, timeouts, API url). The default value is None (a client is created from apikey and rate_limit).
+    - cache (SnapshotCache): An optional parameter that specifies an on-disk cache of the snapshots, only the time ranges missing from the cache are downloaded. The default value is None (no cache).
+    - refresh (bool): An optional parameter that bypasses the cached snapshots and downloads the whole window again. The default value is False.
+The price_usd column holds the USD price of the base asset at the time of each snapshot (nearest price of the spot_exchange_rate endpoint)
+    - price_tolerance (int): An optional parameter that specifies the maximum distance (ms) between a snapshot and its price, NaN beyond. The default value is one interval.
+The instruments are planned before being requested (see plan_depth()): duplicates are removed, and pairs not listed on an exchange are not requested
+    - instruments_file (string): An optional parameter that specifies the local copy of Kaiko's instruments reference data used to prune the pairs that are not listed. The default value is "kaiko_instruments.json". Use None to request every pair.
+    - dry_run (bool): An optional parameter that returns the DepthPlan (planned requests and estimated number of pages) instead of fetching the data. The default value is False.
+    - report (bool): An optional parameter that also returns a FetchReport of the call (requests, pages, bytes, latency, retries and stage timings by instrument), as (df, report). The default value is False.
 '''
 
-def assets_depth(apikey, start_time, end_time, assets, instrument_class, interval, exchanges=['krkn','cbse', 'stmp', 'bnus', 'binc', 'gmni', 'btrx', 'itbi', 'huob', 'btba'], quote_assets=['usd', 'usdt', 'usdc', 'dai', 'busd']):
-    headers = {'Accept': 'application/json',
-               'X-Api-Key': apikey}
-    df_list = []
-    for base_asset in assets:     
+def assets_depth(apikey, start_time, end_time, assets, instrument_class, interval, exchanges=['krkn','cbse', 'stmp', 'bnus', 'binc', 'gmni', 'btrx', 'itbi', 'huob', 'btba'], quote_assets=['usd', 'usdt', 'usdc', 'dai', 'busd'], max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, cache=None, refresh=False, price_tolerance=None, instruments_file=DEFAULT_INSTRUMENTS_FILE, dry_run=False, client=None, report=False):
+    client, fetch_report = _reporting(client or KaikoClient(apikey, rate_limit=rate_limit), report)
+    jobs = []
+    for base_asset in assets:
         for quote_asset in quote_assets:
             instrument = f"{base_asset}-{quote_asset}"
             for exchange in exchanges:
-                try:
-                    url = f'https://us.market-api.kaiko.io/v2/data/order_book_snapshots.v1/exchanges/{exchange}/{instrument_class}/{instrument}/ob_aggregations/full?start_time={start_time}&end_time={end_time}&interval={interval}'
-                    res = requests.get(url, headers=headers)
-                    df = pd.DataFrame(res.json()['data'])
-                    df['base'] = (base_asset)
-                    df['pair'] = (instrument)
-                    df['exchange'] = (exchange)
-                    while 'next_url' in res.json():
-                        res = requests.get(res.json()['next_url'], headers=headers)
-                        data =  pd.DataFrame(res.json()['data'])
-                        data['base'] = (base_asset)
-                        data['pair'] = (instrument)
-                        data['exchange'] = (exchange)
-                        df = pd.concat([df,data], ignore_index=True)
-                except:
-                    print('no instrument found')
-                df_list.append(df)    
-    final_df = pd.concat(df_list)
-    final_df['poll_date'] = pd.to_datetime(final_df['poll_timestamp'], unit='ms')
+                jobs.append(DepthJob(exchange, instrument_class, instrument, start_time, end_time, interval,
+                                     {'base': base_asset, 'pair': instrument, 'exchange': exchange}))
+    with _stage(client, 'plan'):
+        plan = plan_depth(jobs, instruments_file, client=client)
+    if dry_run:
+        return plan
+    with _stage(client, 'fetch'):
+        blocks = fetch_depth(client, plan.jobs, max_workers, cache=cache, refresh=refresh)
+    with _stage(client, 'concat'):
+        block = DepthBlock.concat(blocks)
+    block = _add_usd_price(block, client, start_time, end_time, assets, interval, max_workers, price_tolerance)
+    with _stage(client, 'to_frame'):
+        final_df = block.to_frame()
+    return (final_df, fetch_report) if report else final_df
+
+
+# USD prices
+
+'''
+The PriceCache class keeps the USD price (spot_exchange_rate endpoint) of each base asset by interval, as a sorted
+Series indexed by timestamp. Each base is fetched once per call, for the time ranges the cache doesn't cover yet,
+so that successive calls (e.g. DepthTail polls or streamed pages) don't download the same prices again.
+Each KaikoClient has its own PriceCache (price_cache), shared by its views: prices are never reused across API urls or
+keys. A series keeps its max_prices most recent prices, the older ones are dropped and downloaded again if needed.
+
+PARAMETERS
+    - max_prices (int): An optional parameter that specifies the maximum number of prices kept by base and interval. The default value is 100000.
+'''
+class PriceCache:
+    def __init__(self, max_prices=100000):
+        self.max_prices = max_prices
+        self._lock = threading.Lock()
+        self._prices = {}
+        self._coverage = {}
+
+    def clear(self):
+        with self._lock:
+            self._prices = {}
+            self._coverage = {}
+
+    '''
+    The prices() method returns a dict {base: Series of USD prices indexed by timestamp (ms)} covering the window.
+    '''
+    def prices(self, client, bases, start_time, end_time, interval, max_workers=DEFAULT_MAX_WORKERS):
+        start, end = _to_ms(start_time), _to_ms(end_time) + 1
+        jobs = []
+        with self._lock:
+            for base in dict.fromkeys(bases):
+                missing = _subtract_ranges(start, end, self._coverage.get((base, interval), []))
+                for missing_start, missing_end in missing:
+                    url = client.crossprice_url(base, 'usd', _to_iso(missing_start), _to_iso(missing_end - 1), interval)
+                    jobs.append((url, missing_start, missing_end, {'base': base, 'quote': 'usd'}))
+                client.emit('cache', kind='price', hit=not missing, ranges=len(missing), cached=0, tags={'base': base, 'quote': 'usd'})
+        frames = fetch_frames(client, jobs, max_workers)
+        # Prices close to now may not be published yet, they are not marked as covered
+        covered_end = int(time.time() * 1000) - _interval_ms(interval)
+        with self._lock:
+            for (url, missing_start, missing_end, tags), df in zip(jobs, frames):
+                if df is None:
+                    continue
+                key = (tags['base'], interval)
+                if len(df):
+                    fetched = pd.Series(pd.to_numeric(df['price'], errors='coerce').to_numpy(),
+                                        index=df['timestamp'].to_numpy(dtype=np.int64)).dropna()
+                    series = pd.concat([self._prices[key], fetched]) if key in self._prices else fetched
+                    self._prices[key] = series[~series.index.duplicated(keep='last')].sort_index()
+                if missing_start < min(missing_end, covered_end):
+                    self._coverage[key] = _merge_ranges(self._coverage.get(key, []) + [(missing_start, min(missing_end, covered_end))])
+            prices = {base: self._prices.get((base, interval), pd.Series(dtype=float)) for base in bases}
+            for key in dict.fromkeys((tags['base'], interval) for url, missing_start, missing_end, tags in jobs):
+                series = self._prices.get(key)
+                if series is not None and len(series) > self.max_prices:
+                    # the oldest prices are dropped, with the part of the coverage they were in
+                    series = self._prices[key] = series.iloc[-self.max_prices:]
+                    first = int(series.index[0])
+                    self._coverage[key] = [(max(start, first), end) for start, end in self._coverage.get(key, []) if end > first]
+            return prices
+
+
+def _block_bases(block):
+    # base asset of each snapshot, from the base key or derived from the pair
+    if 'base' in block.keys:
+        return block.keys['base']
+    pairs = block.keys['pair']
+    bases = np.array([str(pair).split('-')[0] for pair in pairs.categories], dtype=object)
+    return pd.Categorical(bases[pairs.codes])
+
+
+'''
+The align_usd_price() function returns the USD price of each snapshot of a DepthBlock: for each base, the price whose
+timestamp is the nearest to the poll_timestamp of the snapshot (sorted search), if it is within tolerance_ms.
+Snapshots without a price close enough get NaN, they are kept.
+'''
+def align_usd_price(block, prices, tolerance_ms):
+    price = np.full(len(block), np.nan)
+    bases = _block_bases(block)
+    for code, base in enumerate(bases.categories):
+        series = prices.get(base)
+        rows = np.flatnonzero(bases.codes == code)
+        if series is None or not len(series) or not len(rows):
+            continue
+        times, values = series.index.to_numpy(dtype=np.int64), series.to_numpy()
+        polls = block.timestamps[rows]
+        after = np.searchsorted(times, polls)
+        before = np.clip(after - 1, 0, len(times) - 1)
+        after = np.clip(after, 0, len(times) - 1)
+        nearest = np.where(np.abs(times[before] - polls) <= np.abs(times[after] - polls), before, after)
+        matched = np.abs(times[nearest] - polls) <= tolerance_ms
+        price[rows[matched]] = values[nearest[matched]]
+    return price
+
+
+def _add_usd_price(block, client, start_time, end_time, assets, interval, max_workers=DEFAULT_MAX_WORKERS, price_tolerance=None):
     # add each base asset's price in USD (usefull for conversions)
-    def get_crossprice(apikey, start_time, end_time, base_assets, interval, quote_assets=['usd']):
-        headers = {'Accept': 'application/json',
-                'X-Api-Key': apikey}
-        data_list = []
-        for base in base_assets:
-            for quote in quote_assets:
-                try:
-                    url = f'https://us.market-api.kaiko.io/v2/data/trades.v1/spot_exchange_rate/{base}/{quote}?start_time={start_time}&end_time={end_time}&interval={interval}'
-                    res = requests.get(url, headers=headers)
-                    df = pd.DataFrame(res.json()['data'])
-                    df['base'] = (base)
-                    df['quote'] = (quote)
-                    while 'next_url' in res.json():
-                        res = requests.get(res.json()['next_url'], headers=headers)
-                        data =  pd.DataFrame(res.json()['data'])
-                        data['base'] = (base)
-                        data['quote'] = (quote)
-                        df = pd.concat([df,data], ignore_index=True)
-                except:
-                    print('no instrument found')
-                data_list.append(df)    
-        final_df = pd.concat(data_list)
-        return final_df
-    cross = get_crossprice(apikey, start_time, end_time, assets, interval)
-    merged_df = pd.merge(cross, 
-                     final_df,
-                     left_on=['timestamp', 'base'],
-                     right_on=['poll_timestamp', 'base'])
-    merged_df = merged_df.drop(columns=['quote', 'timestamp', 'base'])
-    merged_df = merged_df.rename(columns={'price': 'price_usd'})
-    def convert_to_numeric(df, column_list):
-        for column in column_list:
-            df[column] = pd.to_numeric(df[column], errors='coerce')
-        return df
-    columns_to_convert = ['bid_volume0_1','bid_volume0_2', 'bid_volume0_3', 'bid_volume0_4', 'bid_volume0_5',
-           'bid_volume0_6', 'bid_volume0_7', 'bid_volume0_8', 'bid_volume0_9',
-           'bid_volume1', 'bid_volume1_5', 'bid_volume2', 'bid_volume4',
-           'bid_volume6', 'bid_volume8', 'bid_volume10', 'ask_volume0_1',
-           'ask_volume0_2', 'ask_volume0_3', 'ask_volume0_4', 'ask_volume0_5',
-           'ask_volume0_6', 'ask_volume0_7', 'ask_volume0_8', 'ask_volume0_9',
-           'ask_volume1', 'ask_volume1_5', 'ask_volume2', 'ask_volume4',
-           'ask_volume6', 'ask_volume8', 'ask_volume10', 'mid_price', 'price_usd']
-    merged_df = convert_to_numeric(merged_df, columns_to_convert)
-    return merged_df
-
-def create_json(df, filename, usd=False): 
+    with _stage(client, 'prices'):
+        prices = client.price_cache.prices(client, assets, start_time, end_time, interval, max_workers)
+    tolerance = _interval_ms(interval) if price_tolerance is None else price_tolerance
+    with _stage(client, 'align_prices'):
+        block.extras['price_usd'] = align_usd_price(block, prices, tolerance)
+    return block
+
+
+def _usd_depth(df):
+    # depth columns of a DataFrame in USD, one broadcast multiply
+    return pd.DataFrame(df[DEPTH_COLUMNS].to_numpy(dtype=float) * df['price_usd'].to_numpy(dtype=float)[:, None],
+                        index=df.index, columns=DEPTH_COLUMNS)
+
+
+'''
+The create_json() function writes the average depths of each base asset to a JSON file, and returns the JSON.
+The metrics of liquidity_metrics() or cross_exchange_liquidity() (a DataFrame) can be given with metrics:
+their average by base asset is added to the depths of the asset.
+'''
+def create_json(df, filename, usd=False, metrics=None): 
     # TODO: get rid of usd parameter, or correct the way this is working to allow conversion to non-stable assets
-    cols = ['bid_volume0_1','bid_volume0_2', 'bid_volume0_3', 'bid_volume0_4', 'bid_volume0_5',
-               'bid_volume0_6', 'bid_volume0_7', 'bid_volume0_8', 'bid_volume0_9',
-               'bid_volume1', 'bid_volume1_5', 'bid_volume2', 'bid_volume4',
-               'bid_volume6', 'bid_volume8', 'bid_volume10', 'ask_volume0_1',
-               'ask_volume0_2', 'ask_volume0_3', 'ask_volume0_4', 'ask_volume0_5',
-               'ask_volume0_6', 'ask_volume0_7', 'ask_volume0_8', 'ask_volume0_9',
-               'ask_volume1', 'ask_volume1_5', 'ask_volume2', 'ask_volume4',
-               'ask_volume6', 'ask_volume8', 'ask_volume10']
+    if isinstance(df, (DepthDataset, DepthRollup)):
+        return _write_json(_with_metrics(df.group_means('base', usd), metrics), filename)
+    cols = DEPTH_COLUMNS
     df[['base', 'quote']] = df['pair'].str.split("-", expand=True)
-    if usd:
-        df[cols] = df[cols].mul(df['price_usd'], axis=0)
-    df = df.groupby('base')[cols].mean()
+    depth = _usd_depth(df) if usd else df[cols]
+    df = depth.groupby(df['base'], observed=True).mean()
+    return _write_json(_with_metrics(df, metrics), filename)
+
+
+def _write_json(df, filename):
     data = df.to_json(orient="index")
     with open(filename, "w") as f:
         f.write(data)
     return data
 
 def assets_heatmap(df, file_name=None, show=False):
-    
-    # multiply desired columns with mid_price
-    cols = ['bid_volume0_1', 'bid_volume0_2', 'bid_volume0_3', 'bid_volume0_4', 'bid_volume0_5',
-            'bid_volume0_6', 'bid_volume0_7', 'bid_volume0_8', 'bid_volume0_9',
-            'bid_volume1', 'bid_volume1_5', 'bid_volume2', 'bid_volume4',
-            'bid_volume6', 'bid_volume8', 'bid_volume10', 'ask_volume0_1',
-            'ask_volume0_2', 'ask_volume0_3', 'ask_volume0_4', 'ask_volume0_5',
-            'ask_volume0_6', 'ask_volume0_7', 'ask_volume0_8', 'ask_volume0_9',
-            'ask_volume1', 'ask_volume1_5', 'ask_volume2', 'ask_volume4',
-            'ask_volume6', 'ask_volume8', 'ask_volume10']
-    df[cols] = df[cols].multiply(df['price_usd'], axis=0)
-
-    # group by base and calculate the mean of the desired columns
-    df = df.groupby('base')[cols].mean()
-    
-    # Transpose the dataframe
-    df = df.T
-    
-    # Create a figure and axis
-    fig, ax = plt.subplots(figsize=(10, 8))
-    
-    # Create a heatmap of the dataframe values
-    im = ax.imshow(df, cmap='YlGnBu')
-    
-    # Add a colorbar
-    fig.colorbar(im)
-    
-    # Add labels to the x and y axis
-    ax.set_xticks(range(df.shape[1]))
-    ax.set_yticks(range(df.shape[0]))
-    ax.set_xticklabels(df.columns)
-    ax.set_yticklabels(df.index)
-    
-    # Add a title to the heatmap
-    plt.title("Assets Market Depth\n")
-    
-    # Rotate the x-axis labels
-    plt.xticks(rotation=70)
-    
-    if file_name:
-        # Save the plot
-        plt.savefig(file_name, format='jpeg')
-    
-    if show:
-        # Show the plot
-        plt.show()
+    _draw_heatmap(_heatmap_means(df, 'base'), HEATMAP_TITLES['base'], file_name, show)
+
+
+
+# Batch rendering
+
+# Chart functions drawn by render_charts(): figure size and drawing function (figure, data, values)
+_CHARTS = {'market_depth_chart': ((10, 6), _plot_market_depth_chart),
+           'asset_depth_chart': ((15, 6), _plot_asset_depth_chart),
+           'market_heatmap': ((10, 8), lambda fig, df, values: _plot_heatmap(fig, _heatmap_means(df, 'label'), HEATMAP_TITLES['label'])),
+           'asset_heatmap': ((10, 8), lambda fig, df, values: _plot_heatmap(fig, _heatmap_means(df, 'exchange'), HEATMAP_TITLES['exchange'])),
+           'assets_heatmap': ((10, 8), lambda fig, df, values: _plot_heatmap(fig, _heatmap_means(df, 'base'), HEATMAP_TITLES['base']))}
+
+# Figures reused by render_charts(), by thread and figure size
+_FIGURES = threading.local()
+
+
+def _render_chart(chart):
+    function, df, file_name = chart[:3]
+    name = function if isinstance(function, str) else function.__name__
+    if name not in _CHARTS:
+        raise ValueError(f'{name} is not one of the chart functions: {", ".join(_CHARTS)}')
+    size, plot = _CHARTS[name]
+    figures = _FIGURES.__dict__.setdefault('figures', {})
+    if size not in figures:
+        # a plain Figure, outside of pyplot: it isn't kept by pyplot, and is cleared and drawn again for the next chart
+        _pyplot()
+        from matplotlib.figure import Figure
+        figures[size] = Figure(figsize=size)
+    fig = figures[size]
+    fig.clear()
+    plot(fig, df, chart[3] if len(chart) > 3 else None)
+    fig.savefig(file_name, format='jpeg')
+    return file_name
+
+
+'''
+The render_charts() function draws many charts and heatmaps to files at once, in a pool of worker processes.
+The figures are not created through pyplot: each worker keeps one figure by size, cleared and reused from a chart
+to the next, so that the memory doesn't grow with the number of charts.
+
+PARAMETERS
+    - charts (list of tuples): A required parameter, (function, df, file_name) tuples for the heatmaps and
+      (function, df, file_name, values) tuples for the line charts, function being one of market_depth_chart,
+      asset_depth_chart, market_heatmap, asset_heatmap and assets_heatmap (the function or its name).
+      df is what the function accepts (DataFrame, DepthDataset or DepthRollup).
+    - max_workers (int): An optional parameter that specifies the number of worker processes. The default value is None
+      (one per CPU). With 1, the charts are drawn in the calling process.
+
+EXAMPLE
+    render_charts([(market_depth_chart, df, 'bid_1.jpeg', 'bid_volume1'),
+                   (market_depth_chart, df, 'ask_1.jpeg', 'ask_volume1'),
+                   (market_heatmap, df, 'heatmap.jpeg')])
+'''
+def render_charts(charts, max_workers=None):
+    charts = list(charts)
+    if max_workers == 1 or len(charts) <= 1:
+        return [_render_chart(chart) for chart in charts]
+    # the functions are sent to the workers by name
+    charts = [(chart[0] if isinstance(chart[0], str) else chart[0].__name__,) + tuple(chart[1:]) for chart in charts]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_render_chart, charts))
+
+
+
+# Liquidity metrics
+
+_PCTS = np.asarray(DEPTH_PCTS)
+
+# Number of snapshots processed at once by the metrics, it bounds the memory used by the temporary arrays
+METRICS_CHUNK_SIZE = 1 << 18
+
+
+def _label(value):
+    # 100000 -> '100000', 0.25 -> '0_25', as the depth levels
+    return f'{value:f}'.rstrip('0').rstrip('.').replace('.', '_')
+
+
+def _metric_inputs(df, usd):
+    # DepthBlock of a DataFrame (or the block itself), and the price converting its volumes into the notional currency
+    block = df if isinstance(df, DepthBlock) else DepthBlock.from_frame(df)
+    column = 'price_usd' if usd else 'mid_price'
+    if column not in block.extras:
+        raise ValueError(f'the {column} column is needed to compute the metrics' + (' (or use usd=False)' if usd else ''))
+    return block, np.asarray(block.extras[column], dtype=np.float64)
+
+
+def _metric_keys(block):
+    # base, exchange and pair of each snapshot, the base derived from the pair when it is missing
+    keys = dict(block.keys)
+    if 'base' not in keys and 'pair' in keys:
+        pair = keys['pair']
+        bases = np.asarray([str(category).split('-')[0] for category in pair.categories], dtype=object)
+        keys = {'base': pd.Categorical(np.where(pair.codes >= 0, bases[pair.codes], None)), **keys}
+    return {column: keys[column] for column in INSTRUMENT_KEYS if column in keys}
+
+
+# Middle of each step of the depth ladder (%), from the previous level (the mid price for the first one)
+_STEP_PCTS = (_PCTS + np.concatenate([[0.0], _PCTS[:-1]])) / 2
+
+
+'''
+The _slippage() function fills market orders of the given notionals against cumulative depth ladders of shape
+(snapshots, 16 levels), in the notional currency. The depth is taken as spread evenly between two levels.
+It returns, for each notional, the average distance (%) to the mid price of the filled notional and the distance of
+the last unit filled, NaN when the 10% depth is smaller than the notional or the ladder has missing levels.
+'''
+def _slippage(ladder, notionals):
+    valid = ~np.isnan(ladder).any(axis=1)
+    # the depth is cumulative, a noisy level can't be below the previous one
+    ladder = np.maximum.accumulate(np.nan_to_num(ladder), axis=1)
+    # notional x distance filled up to each level
+    filled = np.cumsum(np.diff(ladder, axis=1, prepend=0.0) * _STEP_PCTS, axis=1)
+    rows = np.arange(len(ladder))
+    results = []
+    for notional in notionals:
+        # level reaching the notional: ladder[k - 1] < notional <= ladder[k] (k = 16 if the notional is never reached)
+        k = (ladder < notional).sum(axis=1)
+        reached = valid & (k < ladder.shape[1])
+        level = np.minimum(k, ladder.shape[1] - 1)
+        lower = np.where(k > 0, ladder[rows, level - 1], 0.0)
+        pct_lower = np.where(k > 0, _PCTS[level - 1], 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            impact = pct_lower + (notional - lower) / (ladder[rows, level] - lower) * (_PCTS[level] - pct_lower)
+        # filled in the levels before, plus the part filled in the last level
+        average = (np.where(k > 0, filled[rows, level - 1], 0.0) + (notional - lower) * (pct_lower + impact) / 2) / notional
+        results.append((np.where(reached, average, np.nan), np.where(reached, impact, np.nan)))
+    return results
+
+
+def _depth_at(volumes, pct):
+    # cumulative depth at any distance (%), linearly interpolated between the levels (0 at the mid price)
+    level = int(np.searchsorted(_PCTS, pct))
+    if level == len(_PCTS) or pct < 0:
+        return np.full(volumes.shape[:1] + volumes.shape[2:], np.nan)
+    lower = volumes[:, level - 1] if level else 0.0
+    pct_lower = _PCTS[level - 1] if level else 0.0
+    return lower + (pct - pct_lower) / (_PCTS[level] - pct_lower) * (volumes[:, level] - lower)
+
+
+def _imbalance(volumes):
+    total = volumes[:, :, 0] + volumes[:, :, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, (volumes[:, :, 0] - volumes[:, :, 1]) / total, np.nan)
+
+
+'''
+The liquidity_metrics() function returns a DataFrame of liquidity metrics for each snapshot, computed on the depth
+ladder as NumPy arrays of shape (snapshots, 16 levels, 2 sides), for all the snapshots at once (by chunks of
+METRICS_CHUNK_SIZE snapshots), without any row by row loop:
+    - buy_slippage_N / sell_slippage_N: average distance (%) to the mid price of a market order of notional N
+      (USD, or quote currency with usd=False), filled against the ask / bid side, NaN if the 10% depth is too small
+    - buy_impact_N / sell_impact_N: distance (%) to the mid price of the last unit filled by that order
+    - imbalanceX: (bid - ask) / (bid + ask) depth at each level of DEPTH_LEVELS, from -1 (asks only) to 1 (bids only)
+    - bid_depthX / ask_depthX: depth at any distance X (%) to the mid price, interpolated between the levels
+      (USD, or base units with usd=False)
+The base, exchange, pair and poll_timestamp of the snapshots are kept, the metrics can be exported with create_json().
+
+PARAMETERS
+    - df (DataFrame or DepthBlock): A required parameter, snapshots returned by one of the fetchers.
+    - notionals (list of float): An optional parameter, the order sizes of the slippage. The default value is [10000, 100000, 1000000].
+    - pcts (list of float): An optional parameter, the distances (%) of the interpolated depths. The default value is [0.25, 0.75, 3, 5].
+    - usd (bool): An optional parameter, the notionals and depths in USD (needs the price_usd column of assets_depth()),
+      or in quote currency and base units (uses mid_price). The default value is True.
+
+EXAMPLE
+    df = assets_depth(apikey, start_time, end_time, ['btc', 'eth'], 'spot', '1m')
+    metrics = liquidity_metrics(df, notionals=[50000, 250000])
+    create_json(df, 'depth_results.json', usd=True, metrics=metrics)
+'''
+def liquidity_metrics(df, notionals=[10000, 100000, 1000000], pcts=[0.25, 0.75, 3, 5], usd=True):
+    block, price = _metric_inputs(df, usd)
+    n = len(block)
+    columns = {}
+    for notional in notionals:
+        for name in ('buy_slippage', 'sell_slippage', 'buy_impact', 'sell_impact'):
+            columns[f'{name}_{_label(notional)}'] = np.empty(n)
+    for level in DEPTH_LEVELS:
+        columns[f'imbalance{level}'] = np.empty(n)
+    for pct in pcts:
+        columns[f'bid_depth{_label(pct)}'] = np.empty(n)
+        columns[f'ask_depth{_label(pct)}'] = np.empty(n)
+    for start in range(0, n, METRICS_CHUNK_SIZE):
+        chunk = slice(start, start + METRICS_CHUNK_SIZE)
+        volumes = block.volumes[chunk]
+        notional_volumes = volumes * price[chunk, None, None]
+        for side, name in ((1, 'buy'), (0, 'sell')):
+            for notional, (slippage, impact) in zip(notionals, _slippage(notional_volumes[:, :, side], notionals)):
+                columns[f'{name}_slippage_{_label(notional)}'][chunk] = slippage
+                columns[f'{name}_impact_{_label(notional)}'][chunk] = impact
+        imbalance = _imbalance(volumes)
+        for i, level in enumerate(DEPTH_LEVELS):
+            columns[f'imbalance{level}'][chunk] = imbalance[:, i]
+        for pct in pcts:
+            depth = _depth_at(notional_volumes if usd else volumes, pct)
+            columns[f'bid_depth{_label(pct)}'][chunk] = depth[:, 0]
+            columns[f'ask_depth{_label(pct)}'][chunk] = depth[:, 1]
+    return pd.DataFrame({**_metric_keys(block), 'poll_timestamp': block.timestamps, **columns})
+
+
+'''
+The cross_exchange_liquidity() function consolidates the order books of every exchange (and pair) of a base asset,
+snapshot time by snapshot time, as if a single order could be routed across all of them. Each venue contributes in
+proportion to its liquidity. It returns one row per (base, poll_timestamp) with:
+    - venues: the number of exchange-pair instruments consolidated
+    - total_bid_volumeX / total_ask_volumeX: the consolidated depth at each level of DEPTH_LEVELS (USD, or quote currency with usd=False)
+    - buy_slippage_N / sell_slippage_N and buy_impact_N / sell_impact_N: the slippage of the consolidated book (see liquidity_metrics())
+    - spread_pct: the spread (% of the mid price) of the venues, weighted by their 1% depth
+
+PARAMETERS
+    - df (DataFrame or DepthBlock): A required parameter, snapshots returned by one of the fetchers.
+    - notionals (list of float): An optional parameter, the order sizes of the slippage. The default value is [10000, 100000, 1000000].
+    - by (string): An optional parameter, the key consolidated: 'base' or 'pair' (across exchanges only). The default value is 'base'.
+    - usd (bool): An optional parameter, the depths and notionals in USD (needs the price_usd column) or in quote currency,
+      which is only meaningful with by='pair'. The default value is True.
+'''
+def cross_exchange_liquidity(df, notionals=[10000, 100000, 1000000], by='base', usd=True):
+    block, price = _metric_inputs(df, usd)
+    key = _metric_keys(block)[by]
+    timestamps, time_codes = np.unique(block.timestamps, return_inverse=True)
+    groups, group = np.unique(key.codes.astype(np.int64) * len(timestamps) + time_codes, return_inverse=True)
+    size = len(groups)
+    ladder = (block.volumes * price[:, None, None]).reshape(len(block), -1)
+    totals = np.empty((size, ladder.shape[1]))
+    for column in range(ladder.shape[1]):
+        values = ladder[:, column]
+        totals[:, column] = np.bincount(group, weights=np.where(np.isnan(values), 0.0, values), minlength=size)
+    totals = totals.reshape(size, len(DEPTH_LEVELS), 2)
+    result = {by: pd.Categorical.from_codes(groups // len(timestamps), key.categories),
+              'poll_timestamp': timestamps[groups % len(timestamps)],
+              'venues': np.bincount(group, minlength=size)}
+    for side, name in ((0, 'bid'), (1, 'ask')):
+        for i, level in enumerate(DEPTH_LEVELS):
+            result[f'total_{name}_volume{level}'] = totals[:, i, side]
+    for side, name in ((1, 'buy'), (0, 'sell')):
+        for notional, (slippage, impact) in zip(notionals, _slippage(totals[:, :, side], notionals)):
+            result[f'{name}_slippage_{_label(notional)}'], result[f'{name}_impact_{_label(notional)}'] = slippage, impact
+    if 'spread' in block.extras and 'mid_price' in block.extras:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spread = np.asarray(block.extras['spread'], dtype=np.float64) / np.asarray(block.extras['mid_price'], dtype=np.float64) * 100
+        weight = np.nan_to_num(ladder[:, 2 * DEPTH_LEVELS.index('1')] + ladder[:, 2 * DEPTH_LEVELS.index('1') + 1])
+        weight = np.where(np.isnan(spread), 0.0, weight)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['spread_pct'] = (np.bincount(group, weights=weight * np.nan_to_num(spread), minlength=size)
+                                    / np.bincount(group, weights=weight, minlength=size))
+    return pd.DataFrame(result)
+
+
+def _with_metrics(means, metrics):
+    # average the metrics of each base (see liquidity_metrics()) and add them to the average depths
+    if metrics is None:
+        return means
+    base = metrics['base'] if 'base' in metrics else metrics['pair'].astype(str).str.split('-').str[0]
+    columns = [column for column in metrics.columns
+               if column not in INSTRUMENT_KEYS and column != 'poll_timestamp' and pd.api.types.is_numeric_dtype(metrics[column])]
+    return means.join(metrics[columns].groupby(base, observed=True).mean(), how='outer')
+
+
+
+# Incremental polling
+
+'''
+The DepthTail class keeps an up to date market depth dataset for a list of assets, the same way assets_depth() does,
+without downloading again the snapshots it already has. Each call to poll() only requests, for each instrument
+(exchange + pair), the snapshots newer than the last poll_timestamp received for it, and appends them to the frame.
+
+A DepthRollup (sums and counts by base, exchange, pair and hour/day) is updated with each batch of new snapshots, so that
+the average depths used by create_json() and the heatmaps are recomputed without a groupby over the whole history.
+
+PARAMETERS
+    - apikey (string): A required parameter that specifies the API key to access the market data.
+    - assets (list of strings): A required parameter, the list of base assets to follow (e.g. ['btc', 'eth']).
+    - interval (string): A required parameter that specifies the time interval of the snapshots (e.g. "1m").
+    - start_time (string): A required parameter that specifies the start time of the first poll in UTC, in ISO 8601 (e.g. "2022-01-01T00:00:00Z").
+    - exchanges, quote_assets, instrument_class: Optional parameters, with the same defaults as assets_depth().
+    - usd (bool): An optional parameter that adds the price_usd column to the snapshots, as assets_depth() does. The default value is True.
+    - max_workers, rate_limit, cache: Optional parameters passed to the fetch engine (see fetch_depth()).
+    - client (KaikoClient): An optional parameter that specifies the HTTP client to use. The default value is None (a client is created from apikey and rate_limit).
+    - instruments_file (string): An optional parameter, the instruments reference data used to prune the pairs that are not listed (see plan_depth()).
+    - keep_frame (bool): An optional parameter that keeps the snapshots received in frame. The default value is True. Use False for a
+      long-running tail that only needs the rollup (e.g. DepthService), its memory doesn't grow with the history.
+
+EXAMPLE
+    tail = DepthTail(apikey, ['btc', 'eth'], '1m', start_time='2023-02-05T00:00:00Z')
+    while True:
+        tail.poll()
+        tail.create_json('depth_results.json', usd=True)
+        time.sleep(300)
+'''
+class DepthTail:
+    def __init__(self, apikey, assets, interval, start_time, exchanges=['krkn','cbse', 'stmp', 'bnus', 'binc', 'gmni', 'btrx', 'itbi', 'huob', 'btba'],
+                 quote_assets=['usd', 'usdt', 'usdc', 'dai', 'busd'], instrument_class='spot', usd=True,
+                 max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, cache=None, instruments_file=DEFAULT_INSTRUMENTS_FILE, client=None,
+                 keep_frame=True):
+        self.client = client or KaikoClient(apikey, rate_limit=rate_limit)
+        self.assets = assets
+        self.interval = interval
+        self.start_time = start_time
+        self.instrument_class = instrument_class
+        self.usd = usd
+        self.max_workers = max_workers
+        self.cache = cache
+        self.keep_frame = keep_frame
+        # the pairs that are not listed are pruned once, when the tail is created
+        jobs = [DepthJob(exchange, instrument_class, f"{base}-{quote}", start_time, _to_iso(int(time.time() * 1000)), interval, {'base': base})
+                for base in assets for quote in quote_assets for exchange in exchanges]
+        self.instruments = [(job.tags['base'], job.instrument, job.exchange) for job in plan_depth(jobs, instruments_file, client=self.client).jobs]
+        # last poll_timestamp received by (exchange, pair)
+        self.last_poll = {}
+        self._frame = None
+        self._pending = []
+        # average depths by hour and day, see DepthRollup
+        self.rollup = DepthRollup()
+
+    def _jobs(self, end_time):
+        jobs = []
+        for base, pair, exchange in self.instruments:
+            last = self.last_poll.get((exchange, pair))
+            start_time = self.start_time if last is None else _to_iso(last + 1)
+            jobs.append(DepthJob(exchange, self.instrument_class, pair, start_time, end_time, self.interval,
+                                 {'base': base, 'pair': pair, 'exchange': exchange}))
+        return jobs
+
+    '''
+    The poll() method fetches the snapshots published since the previous poll (up to end_time, now by default),
+    appends them to the frame, updates the rollup and returns the new snapshots.
+    '''
+    def poll(self, end_time=None):
+        if end_time is None:
+            end_time = _to_iso(int(time.time() * 1000))
+        jobs = self._jobs(end_time)
+        blocks = [block for block in fetch_depth(self.client, jobs, self.max_workers, cache=self.cache)
+                  if block is not None and len(block)]
+        if not blocks:
+            return pd.DataFrame()
+        for block in blocks:
+            self.last_poll[(block.keys['exchange'][0], block.keys['pair'][0])] = int(block.timestamps.max())
+        new_block = DepthBlock.concat(blocks)
+        if self.usd:
+            start_time = min(jobs, key=lambda job: _to_ms(job.start_time)).start_time
+            _add_usd_price(new_block, self.client, start_time, end_time, self.assets, self.interval, self.max_workers)
+        new_df = new_block.to_frame()
+        self.rollup.update(new_df)
+        if self.keep_frame:
+            self._pending.append(new_df)
+        return new_df
+
+    @property
+    def frame(self):
+        # All the snapshots received so far
+        if self._pending:
+            self._frame = pd.concat(([self._frame] if self._frame is not None else []) + self._pending)
+            self._pending = []
+        return self._frame
+
+    '''
+    The means() method returns the average depths grouped by 'base', 'exchange', 'pair' or 'label' (exchange-pair),
+    computed from the rollup, over the whole history or from start_time to end_time. With usd=True the depths are expressed in USD.
+    '''
+    def means(self, by='base', usd=False, start_time=None, end_time=None):
+        return self.rollup.group_means(by, usd, start_time, end_time)
+
+    '''
+    The create_json() method writes the same JSON as the create_json() function would for the whole frame.
+    '''
+    def create_json(self, filename, usd=False):
+        return _write_json(self.means('base', usd), filename)
+
+    '''
+    The heatmap() method draws the heatmap of the average depths grouped by 'label' (as market_heatmap()),
+    'exchange' (as asset_heatmap()) or 'base' (as assets_heatmap(), in USD).
+    '''
+    def heatmap(self, by='base', file_name=None, show=False):
+        _draw_heatmap(self.means(by, usd=(by == 'base' and self.usd)), HEATMAP_TITLES[by], file_name, show)
+
+
+
+# Streaming ingestion
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('pyarrow is required to write and read Parquet depth datasets (pip install pyarrow)')
+    return pyarrow
+
+
+'''
+The iter_depth() generator streams the snapshots of a list of DepthJob, one DepthBlock per page, as soon as the pages
+are downloaded. The jobs run concurrently (as in fetch_depth()) and the pages are handed over through a bounded queue,
+so that only a few pages are held in memory at a time. Pages of different jobs are interleaved.
+
+PARAMETERS
+    - client (KaikoClient or string): A required parameter that specifies the client (or the API key) used to send the requests.
+    - jobs (list of DepthJob): A required parameter that specifies the instruments and time windows to retrieve.
+    - max_workers (int): An optional parameter that specifies the maximum number of requests in flight. The default value is 8.
+    - rate_limit (float): An optional parameter that specifies the maximum number of requests per second sent to a host, when client is an API key. The default value is 10.
+    - queue_size (int): An optional parameter that specifies the maximum number of pages waiting to be consumed. The default value is 2 * max_workers.
+'''
+def iter_depth(client, jobs, max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, queue_size=None):
+    client = _client(client, rate_limit)
+    max_workers = max(1, max_workers or 1)
+    pages = queue.Queue(maxsize=queue_size or 2 * max_workers)
+    stop = threading.Event()
+    job_done = object()
+    def put(item):
+        # Wait for room in the queue, unless the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def fetch(job):
+        job_client = client.traced(tags=job.tags)
+        started = time.perf_counter()
+        records, build, error = 0, 0.0, None
+        try:
+            url = client.depth_url(job.exchange, job.instrument_class, job.instrument, job.start_time, job.end_time, job.interval)
+            for page in _iter_pages(job_client, url):
+                built = time.perf_counter()
+                block = DepthBlock.from_records(page, job.tags)
+                build += time.perf_counter() - built
+                records += len(page)
+                if not put(block):
+                    return
+        except Exception as exc:
+            error = str(exc)
+            print('not available: ' + ' / '.join(str(value) for value in job.tags.values()))
+        finally:
+            job_client.emit('job', seconds=time.perf_counter() - started, build=build, records=records, error=error)
+            put(job_done)
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for job in jobs:
+            pool.submit(fetch, job)
+        remaining = len(jobs)
+        while remaining:
+            item = pages.get()
+            if item is job_done:
+                remaining -= 1
+            elif len(item):
+                yield item
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)
+
+
+'''
+The ParquetSink class writes DataFrames of snapshots incrementally to a Parquet dataset partitioned by
+exchange and pair (hive layout: path/exchange=cbse/pair=btc-usd/part-....parquet). Rows are buffered by
+partition and written as row groups of row_group_size rows; when more than max_buffered_rows rows are buffered over
+all the partitions, the largest buffers are written until half of them are left, so that the memory used doesn't grow
+with the dataset. close() must be called (or use it as a context manager).
+
+PARAMETERS
+    - path (string): A required parameter that specifies the directory of the dataset.
+    - partition_cols (list of strings): An optional parameter that specifies the partitioning columns. The default value is ['exchange', 'pair'].
+    - row_group_size (int): An optional parameter that specifies the number of rows of a partition buffered before a write. The default value is 50000.
+    - max_buffered_rows (int): An optional parameter that specifies the maximum number of rows buffered over all the partitions. The default value is 200000.
+'''
+class ParquetSink:
+    def __init__(self, path, partition_cols=['exchange', 'pair'], row_group_size=50000, max_buffered_rows=200000):
+        self.path = path
+        self.partition_cols = partition_cols
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self._writers = {}
+        # chunks and number of rows buffered by partition
+        self._buffers = {}
+        self._buffered = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, df):
+        for values, part in df.groupby(self.partition_cols, observed=True, sort=False):
+            key = values if isinstance(values, tuple) else (values,)
+            self._buffers.setdefault(key, []).append(part.drop(columns=self.partition_cols))
+            self._buffered[key] = self._buffered.get(key, 0) + len(part)
+            if self._buffered[key] >= self.row_group_size:
+                self._flush(key)
+        if sum(self._buffered.values()) > self.max_buffered_rows:
+            # many partitions below row_group_size: the largest ones are written first
+            for key in sorted(self._buffered, key=self._buffered.get, reverse=True):
+                self._flush(key)
+                if sum(self._buffered.values()) <= self.max_buffered_rows // 2:
+                    break
+
+    def _flush(self, key):
+        pa = _pyarrow()
+        self._buffered.pop(key, None)
+        chunks = self._buffers.pop(key, [])
+        if not chunks:
+            return
+        table = pa.Table.from_pandas(pd.concat(chunks, ignore_index=True), preserve_index=False)
+        writer = self._writers.get(key)
+        if writer is None:
+            directory = os.path.join(self.path, *[f'{column}={value}' for column, value in zip(self.partition_cols, key)])
+            os.makedirs(directory, exist_ok=True)
+            writer = pa.parquet.ParquetWriter(os.path.join(directory, f'part-{uuid.uuid4().hex}.parquet'), table.schema)
+            self._writers[key] = writer
+        else:
+            # later batches may miss a column or infer another type, they follow the schema of the file
+            columns = [table[name] if name in table.column_names else pa.nulls(len(table), field.type)
+                       for name, field in zip(writer.schema.names, writer.schema)]
+            table = pa.table(columns, names=writer.schema.names).cast(writer.schema)
+        writer.write_table(table)
+
+    def close(self):
+        for key in list(self._buffers):
+            self._flush(key)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+'''
+The DepthDataset class is a lazy reader of a Parquet dataset written by ParquetSink. Nothing is loaded until
+one of its methods is called. It can be passed instead of a DataFrame to the chart and heatmap functions and to
+create_json(): charts only load the columns they plot, heatmaps and create_json() stream the dataset batch by batch.
+
+PARAMETERS
+    - path (string): A required parameter that specifies the directory of the dataset.
+
+EXAMPLE
+    dataset = assets_depth_to_parquet(apikey, 'depth_dataset', start_time, end_time, ['btc', 'eth'], 'spot', '1m')
+    assets_heatmap(dataset, 'assets_heat.jpeg')
+'''
+class DepthDataset:
+    def __init__(self, path):
+        self.path = path
+
+    def _dataset(self):
+        return _pyarrow().dataset.dataset(self.path, format='parquet', partitioning='hive')
+
+    '''
+    The iter_batches() method yields the dataset as DataFrames of at most batch_size rows.
+    columns and filter (a pyarrow.dataset expression, e.g. pyarrow.dataset.field('exchange') == 'cbse') restrict what is read.
+    '''
+    def iter_batches(self, columns=None, filter=None, batch_size=100000):
+        for batch in self._dataset().to_batches(columns=columns, filter=filter, batch_size=batch_size):
+            yield batch.to_pandas()
+
+    def to_frame(self, columns=None, filter=None):
+        return self._dataset().to_table(columns=columns, filter=filter).to_pandas()
+
+    '''
+    The group_means() method returns the average depths grouped by 'base', 'exchange', 'pair' or 'label' (exchange-pair),
+    computed batch by batch. With usd=True the depths are expressed in USD (the dataset needs the price_usd column).
+    '''
+    def group_means(self, by='base', usd=False, filter=None):
+        return self.rollup([], usd, filter).group_means(by, usd)
+
+    '''
+    The rollup() method reads the dataset once, batch by batch, into a DepthRollup (see DepthRollup) of the given bucket sizes.
+    With usd=True the rollup also holds the depths in USD (the dataset needs the price_usd column).
+    '''
+    def rollup(self, resolutions=['1h', '1d'], usd=True, filter=None):
+        columns = ['poll_timestamp', 'exchange', 'pair'] + DEPTH_COLUMNS + (['price_usd'] if usd else [])
+        rollup = DepthRollup(resolutions)
+        for df in self.iter_batches(columns, filter):
+            rollup.update(df)
+        return rollup
+
+
+'''
+The assets_depth_to_parquet() function is the streaming variant of assets_depth(): the snapshots are written to a
+Parquet dataset (see ParquetSink) page by page, with their price_usd column, instead of being gathered in a DataFrame.
+It returns a DepthDataset reading the written dataset.
+
+PARAMETERS
+    - path (string): A required parameter that specifies the directory of the dataset.
+    - usd (bool): An optional parameter that adds the price_usd column, as assets_depth() does. The default value is True.
+    - instruments_file (string): An optional parameter, the instruments reference data used to prune the pairs that are not listed (see plan_depth()).
+    - The other parameters are the ones of assets_depth().
+'''
+def assets_depth_to_parquet(apikey, path, start_time, end_time, assets, instrument_class, interval, exchanges=['krkn','cbse', 'stmp', 'bnus', 'binc', 'gmni', 'btrx', 'itbi', 'huob', 'btba'], quote_assets=['usd', 'usdt', 'usdc', 'dai', 'busd'], usd=True, max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, instruments_file=DEFAULT_INSTRUMENTS_FILE, client=None):
+    client = client or KaikoClient(apikey, rate_limit=rate_limit)
+    jobs = []
+    for base_asset in assets:
+        for quote_asset in quote_assets:
+            instrument = f"{base_asset}-{quote_asset}"
+            for exchange in exchanges:
+                jobs.append(DepthJob(exchange, instrument_class, instrument, start_time, end_time, interval,
+                                     {'base': base_asset, 'pair': instrument, 'exchange': exchange}))
+    # the USD prices are one row per interval and base, they are fetched upfront and aligned with each page
+    if usd:
+        prices = client.price_cache.prices(client, assets, start_time, end_time, interval, max_workers)
+    with ParquetSink(path) as sink:
+        for block in iter_depth(client, plan_depth(jobs, instruments_file, client=client).jobs, max_workers):
+            if usd:
+                block.extras['price_usd'] = align_usd_price(block, prices, _interval_ms(interval))
+            sink.write(block.to_frame(categorical=True))
+    return DepthDataset(path)
+
+
+# Bulk export
+
+'''
+The BulkExport class is a resumable export of the depth of a whole universe (assets x quote assets x exchanges) over a
+long time window, to a directory. The work is split into units, one per (exchange, pair, window), window being a slice
+of the time window (a day by default). The units are fetched batch by batch by the fetch engine (see fetch_depth()),
+and each unit is written and recorded in the manifest as soon as its own download is done, from the fetch threads:
+    - path/units/exchange=.../pair=.../<window start>.parquet: the snapshots of the unit (with price_usd when usd=True),
+      a Parquet dataset that DepthDataset reads (see dataset())
+    - path/manifest.jsonl: one line per completed unit, appended once its file is written
+    - path/export.json: the parameters of the export
+When run() is called again (e.g. after a crash or an expired API key), only the units missing from the manifest are
+fetched. A unit whose instrument is not listed (see plan_depth()) is completed without a file; a unit that fails (or
+whose USD prices fail) is reported in failed and fetched again on the next run, as is a unit whose window ends less than
+an interval ago. A unit is rewritten to the same file, so a unit written but not yet in the manifest when the run
+stopped isn't duplicated. Only one run() at a time should use a directory.
+
+PARAMETERS
+    - path (string): A required parameter that specifies the directory of the export, created if needed.
+    - window (string): An optional parameter that specifies the length of the time window of a unit (e.g. "6h", "1d"). The default value is "1d". Use None for one unit per instrument.
+    - usd (bool): An optional parameter that adds the price_usd column, as assets_depth() does. The default value is True.
+    - The other parameters are the ones of assets_depth().
+
+EXAMPLE
+    export = BulkExport('nightly_depth', '2023-02-01T00:00:00Z', '2023-02-08T00:00:00Z', ['btc', 'eth', 'sol'], 'spot', '1m')
+    export.run(apikey)
+    print(export.status())
+    export.create_json('depth_results.json', usd=True)
+'''
+class BulkExport:
+    def __init__(self, path, start_time, end_time, assets, instrument_class, interval, exchanges=['krkn','cbse', 'stmp', 'bnus', 'binc', 'gmni', 'btrx', 'itbi', 'huob', 'btba'],
+                 quote_assets=['usd', 'usdt', 'usdc', 'dai', 'busd'], window='1d', usd=True):
+        self.path = path
+        self.interval = interval
+        self.usd = usd
+        self.params = {'start_time': start_time, 'end_time': end_time, 'assets': list(assets), 'instrument_class': instrument_class,
+                       'interval': interval, 'exchanges': list(exchanges), 'quote_assets': list(quote_assets), 'window': window, 'usd': usd}
+        os.makedirs(path, exist_ok=True)
+        params_file = os.path.join(path, 'export.json')
+        if os.path.exists(params_file):
+            with open(params_file) as f:
+                if json.load(f) != self.params:
+                    raise ValueError(f'{path} holds an export with other parameters')
+        else:
+            _write_atomic(params_file, json.dumps(self.params, indent=1))
+        self.failed = []
+        # the units are completed from the fetch threads
+        self._lock = threading.Lock()
+        # units by id, in the order they are fetched: window by window
+        start, end = _to_ms(start_time), _to_ms(end_time)
+        span = _interval_ms(window) if window else end - start + 1
+        self.units = {}
+        for window_start in range(start, end + 1, span):
+            window_end = min(end, window_start + span - 1)
+            for base_asset in assets:
+                for quote_asset in quote_assets:
+                    instrument = f"{base_asset}-{quote_asset}"
+                    for exchange in exchanges:
+                        job = DepthJob(exchange, instrument_class, instrument, _to_iso(window_start), _to_iso(window_end), interval,
+                                       {'base': base_asset, 'pair': instrument, 'exchange': exchange})
+                        self.units[self._unit_id(job)] = job
+
+    @staticmethod
+    def _unit_id(job):
+        return f'{job.exchange}/{job.instrument}/{job.start_time}'
+
+    def _unit_file(self, job):
+        # relative to path, the window start (ms) keeps the file names portable
+        return os.path.join('units', f'exchange={job.exchange}', f'pair={job.instrument}', f'{_to_ms(job.start_time)}.parquet')
+
+    '''
+    The completed() method returns the entries of the manifest by unit id: rows written, file (None if the
+    instrument is not listed) and time of completion.
+    '''
+    def completed(self):
+        entries = {}
+        manifest = os.path.join(self.path, 'manifest.jsonl')
+        if not os.path.exists(manifest):
+            return entries
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a run that stopped while writing it
+                    continue
+                entries[entry['unit']] = entry
+        return entries
+
+    def missing(self):
+        completed = self.completed()
+        return [job for unit, job in self.units.items() if unit not in completed]
+
+    def status(self):
+        completed = self.completed()
+        done = [entry for unit, entry in completed.items() if unit in self.units]
+        return {'units': len(self.units), 'completed': len(done), 'empty': sum(entry['file'] is None for entry in done),
+                'missing': len(self.units) - len(done), 'failed': len(self.failed), 'rows': sum(entry['rows'] for entry in done)}
+
+    def _write_unit(self, block, job):
+        pa = _pyarrow()
+        name = self._unit_file(job)
+        target = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # the partition columns are in the directories; the dot prefix hides the file from the dataset until it is complete
+        temporary = os.path.join(os.path.dirname(target), '.' + os.path.basename(target) + '.tmp')
+        df = block.to_frame().drop(columns=['exchange', 'pair'])
+        pa.parquet.write_table(pa.Table.from_pandas(df, preserve_index=False), temporary)
+        os.replace(temporary, target)
+        return name
+
+    def _complete(self, entries):
+        with self._lock, open(os.path.join(self.path, 'manifest.jsonl'), 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _fail(self, job):
+        with self._lock:
+            self.failed.append(self._unit_id(job))
+
+    '''
+    The run() method fetches the missing units, batch_size units at a time, and returns the DepthDataset of the export.
+    The units that failed, or whose USD prices failed when usd=True, are listed in failed (their ids), they are fetched
+    again by the next run(). The units whose window ends less than an interval ago are written but not completed, as
+    their last snapshots may not be published yet: the next run() fetches them again.
+
+    PARAMETERS
+        - apikey (string): An optional parameter that specifies the API key, when no client is given.
+        - client (KaikoClient): An optional parameter that specifies the HTTP client to use. The default value is None (a client is created from apikey and rate_limit).
+        - batch_size (int): An optional parameter that specifies the number of units fetched together. The default value is 4 * max_workers.
+        - max_workers, rate_limit, cache, instruments_file: Optional parameters of the fetch engine (see assets_depth()).
+    '''
+    def run(self, apikey=None, client=None, max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, batch_size=None, cache=None,
+            instruments_file=DEFAULT_INSTRUMENTS_FILE):
+        client = client or KaikoClient(apikey, rate_limit=rate_limit)
+        missing = self.missing()
+        plan = plan_depth(missing, instruments_file, client=client)
+        now = _to_iso(int(time.time() * 1000))
+        self._complete([{'unit': self._unit_id(job), 'rows': 0, 'file': None, 'completed': now} for job in plan.unlisted])
+        self.failed = []
+        jobs = plan.jobs
+        batch_size = batch_size or 4 * max(1, max_workers or 1)
+        for first in range(0, len(jobs), batch_size):
+            batch = jobs[first:first + batch_size]
+            prices = {}
+            if self.usd:
+                # the prices of the batch come first; the units whose prices failed aren't downloaded
+                priced = set()
+                for start_time, end_time in dict.fromkeys((job.start_time, job.end_time) for job in batch):
+                    bases = list(dict.fromkeys(job.tags['base'] for job in batch if (job.start_time, job.end_time) == (start_time, end_time)))
+                    prices[start_time] = client.price_cache.prices(client, bases, start_time, end_time, self.interval, max_workers)
+                    # the price cache holds the other windows too, a failed price request leaves no price in this one
+                    for base, series in prices[start_time].items():
+                        times = series.index.to_numpy(dtype=np.int64)
+                        if np.any((times >= _to_ms(start_time)) & (times <= _to_ms(end_time))):
+                            priced.add((start_time, base))
+                for job in batch:
+                    if (job.start_time, job.tags['base']) not in priced:
+                        self._fail(job)
+                batch = [job for job in batch if (job.start_time, job.tags['base']) in priced]
+            # Snapshots close to now may not be published yet, the units ending after covered_end are written but not completed
+            covered_end = int(time.time() * 1000) - _interval_ms(self.interval)
+
+            def done(job, block):
+                if block is None:
+                    return self._fail(job)
+                if self.usd:
+                    block.extras['price_usd'] = align_usd_price(block, prices[job.start_time], _interval_ms(self.interval))
+                name = self._write_unit(block, job) if len(block) else None
+                if _to_ms(job.end_time) < covered_end:
+                    self._complete([{'unit': self._unit_id(job), 'rows': len(block), 'file': name, 'completed': _to_iso(int(time.time() * 1000))}])
+            fetch_depth(client, batch, max_workers, cache=cache, on_done=done)
+        return self.dataset()
+
+    def dataset(self):
+        return DepthDataset(os.path.join(self.path, 'units'))
+
+    '''
+    The create_json() method writes the average depths of each base asset over the units written so far, as
+    create_json() does, reading the units batch by batch (see DepthDataset).
+    '''
+    def create_json(self, filename, usd=False, metrics=None):
+        if not os.path.isdir(os.path.join(self.path, 'units')):
+            return _write_json(pd.DataFrame(columns=DEPTH_COLUMNS), filename)
+        return create_json(self.dataset(), filename, usd, metrics)
+
+
+def _write_atomic(filename, data):
+    temporary = filename + '.tmp'
+    with open(temporary, 'w') as f:
+        f.write(data)
+    os.replace(temporary, filename)
+
+
+# Query service
+
+def _sum_known(values):
+    # sum of the values that aren't None, None if all of them are
+    known = [value for value in values if value is not None]
+    return sum(known) if known else None
+
+
+def _query_flag(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def _level_pct(level):
+    # depth level as a distance (%) to the mid price: '1', '0_5', '0.5' or 1.5
+    try:
+        pct = float(str(level).replace('_', '.'))
+    except ValueError:
+        raise ValueError(f'invalid depth level: {level}')
+    if not 0 < pct <= DEPTH_PCTS[-1]:
+        raise ValueError(f'the depth level must be between 0 and {DEPTH_PCTS[-1]}%: {level}')
+    return pct
+
+
+'''
+The DepthService class is a long-running query service over the depth of a DepthTail: the tail is polled every
+refresh_every seconds in a background thread, and queries are answered from memory, from the rollup of the tail
+(average depths) and from the last snapshot of each instrument (latest depths), without any request to the API.
+The answers are memoized by parameter set; when a poll brings new snapshots, the memoized answers are computed
+again on the refresh thread, so that the queries that are asked repeatedly stay answered from memory.
+
+The queries are methods of the service, and are also served by a local HTTP API (see start()), as JSON:
+    - GET /depth?base=eth&exchanges=cbse,krkn&level=1&usd=true&stat=mean: depth at a level (% to the mid price,
+      interpolated between the levels of DEPTH_LEVELS) of the pairs of a base asset, by exchange and in total
+      (see depth()); stat is 'mean' (optionally with start_time and end_time) or 'latest'
+    - GET /assets?usd=true: the average depths of each base asset, the JSON of create_json() (see assets())
+    - GET /status: time of the last refresh, instruments, number of refreshes with new snapshots and memoized answers
+
+PARAMETERS
+    - tail (DepthTail): A required parameter that specifies the tail serving the depth, preferably created with keep_frame=False.
+    - refresh_every (float): An optional parameter that specifies the time (seconds) between two polls of the tail. The default value is 60.
+    - memo_size (int): An optional parameter that specifies the maximum number of memoized answers. The default value is 1024.
+
+EXAMPLE
+    tail = DepthTail(apikey, ['btc', 'eth'], '1m', start_time='2023-02-05T00:00:00Z', keep_frame=False)
+    service = DepthService(tail, refresh_every=60).start(port=8080)
+    # curl 'http://127.0.0.1:8080/depth?base=eth&exchanges=cbse,krkn&level=1&usd=true'
+'''
+class DepthService:
+    def __init__(self, tail, refresh_every=60, memo_size=1024):
+        self.tail = tail
+        self.refresh_every = refresh_every
+        self.memo_size = memo_size
+        # number of refreshes that brought new snapshots, the memoized answers are the ones of a generation
+        self.generation = 0
+        self.refreshed = None
+        self._lock = threading.Lock()
+        self._memo = {}
+        # last snapshot of each instrument, and the last poll_timestamp of the tail (tail.last_poll is changed by poll())
+        self._latest = None
+        self._as_of = None
+        self._stop = threading.Event()
+        self._server = None
+
+    '''
+    The refresh() method polls the tail and, when new snapshots arrived, computes the memoized answers again.
+    It returns the number of new snapshots. It is called by the refresh thread of start().
+    '''
+    def refresh(self):
+        new_df = self.tail.poll()
+        self.refreshed = time.time()
+        if not len(new_df):
+            return 0
+        latest = pd.concat(([self._latest] if self._latest is not None else []) + [new_df.astype({'exchange': str, 'pair': str})])
+        latest = latest.sort_values('poll_timestamp', kind='stable').drop_duplicates(['exchange', 'pair'], keep='last')
+        as_of = max(self.tail.last_poll.values()) if self.tail.last_poll else None
+        with self._lock:
+            self._latest = latest.reset_index(drop=True)
+            self._as_of = as_of
+            self.generation += 1
+            keys, self._memo = list(self._memo), {}
+        for key in keys:
+            self._answer(key)
+        return len(new_df)
+
+    def _answer(self, key):
+        # memoized answer of a query: (result, JSON body)
+        with self._lock:
+            generation, answer = self.generation, self._memo.pop(key, None)
+            if answer is not None:
+                # most recently used last, the oldest is dropped first
+                self._memo[key] = answer
+                return answer
+        result = getattr(self, '_' + key[0])(*key[1:])
+        answer = (result, json.dumps(result).encode())
+        with self._lock:
+            if generation == self.generation:
+                self._memo[key] = answer
+                while len(self._memo) > self.memo_size:
+                    self._memo.pop(next(iter(self._memo)))
+        return answer
+
+    '''
+    The depth() method returns the depth of the pairs of a base asset at a level, by exchange (sum of its pairs)
+    and in total (sum of the exchanges), for each side:
+    {'base', 'level', 'usd', 'stat', 'as_of', 'exchanges': {exchange: {'bid', 'ask', 'pairs'}}, 'total': {'bid', 'ask'}, 'reason'}
+    A side without any depth (no snapshot, no USD price, or a level beyond the ladder) is None, with the reason, rather
+    than 0. A time range that covers no whole bucket of the rollup (e.g. less than an hour) raises a ValueError (HTTP 400).
+
+    PARAMETERS
+        - base (string): A required parameter, the base asset (e.g. "eth").
+        - exchanges (list of strings): An optional parameter, the exchanges to include. The default value is None (all of them).
+        - level (string or float): An optional parameter, the distance (%) to the mid price (e.g. "1", "0_5", 2.5). The default value is "1".
+        - usd (bool): An optional parameter, the depths in USD (needs a tail with usd=True) or in base units. The default value is True.
+        - stat (string): An optional parameter, 'mean' (average depths over the history of the tail, or from start_time to end_time)
+          or 'latest' (last snapshot of each instrument). The default value is 'mean'.
+    '''
+    def depth(self, base, exchanges=None, level='1', usd=True, stat='mean', start_time=None, end_time=None):
+        return self._answer(self._depth_key(base, exchanges, level, usd, stat, start_time, end_time))[0]
+
+    def _depth_key(self, base, exchanges, level, usd, stat, start_time, end_time):
+        # the parameters of a depth query, normalized: equivalent queries share their memoized answer
+        if stat not in ('mean', 'latest'):
+            raise ValueError(f"stat must be 'mean' or 'latest': {stat}")
+        if usd and not self.tail.usd:
+            raise ValueError('the depths are not available in USD, the tail has no price_usd column (usd=False)')
+        if stat == 'mean':
+            self._check_range(start_time, end_time)
+        return ('depth', base, tuple(sorted(set(exchanges))) if exchanges else None, _level_pct(level), bool(usd), stat, start_time, end_time)
+
+    def _check_range(self, start_time, end_time):
+        # a range that covers no whole bucket of the rollup has no average, it isn't answered with zeros
+        rollup = self.tail.rollup
+        if (start_time is not None or end_time is not None) and not rollup._buckets(start_time, end_time):
+            raise ValueError(f'the time range {start_time} - {end_time} covers no whole bucket of the rollup '
+                             f'({rollup.resolutions[0] // 60000} minutes)')
+
+    def _depth(self, base, exchanges, pct, usd, stat, start_time, end_time):
+        if stat == 'latest':
+            latest = self._latest
+            if latest is None:
+                latest = pd.DataFrame(columns=['base', 'exchange', 'pair'] + DEPTH_COLUMNS + ['price_usd'])
+            rows = latest[latest['base'].astype(str) == base]
+            keys = rows[['exchange', 'pair']].astype(str)
+            depth = _usd_depth(rows) if usd else rows[DEPTH_COLUMNS]
+            as_of = int(rows['poll_timestamp'].max()) if len(rows) else None
+        else:
+            means = self.tail.means(['base', 'exchange', 'pair'], usd, start_time, end_time)
+            if len(means):
+                means = means[means.index.get_level_values('base') == base]
+            keys = pd.DataFrame({'exchange': means.index.get_level_values('exchange') if len(means) else [],
+                                 'pair': means.index.get_level_values('pair') if len(means) else []})
+            depth = means[DEPTH_COLUMNS]
+            as_of = self._as_of
+        selected = keys['exchange'].isin(exchanges).to_numpy() if exchanges else np.ones(len(keys), dtype=bool)
+        volumes = depth.to_numpy(dtype=np.float64)[selected].reshape(-1, 2, len(DEPTH_LEVELS)).transpose(0, 2, 1)
+        values = _depth_at(volumes, pct)
+        # a side without any depth (no snapshot, no price or a level beyond the ladder) is null, not 0
+        by_exchange = {}
+        for exchange, (bid, ask) in zip(keys['exchange'].to_numpy()[selected], values):
+            totals = by_exchange.setdefault(str(exchange), {'bid': None, 'ask': None, 'pairs': 0})
+            for side, value in (('bid', bid), ('ask', ask)):
+                if not np.isnan(value):
+                    totals[side] = (totals[side] or 0.0) + float(value)
+            totals['pairs'] += 1
+        total = {side: _sum_known(totals[side] for totals in by_exchange.values()) for side in ('bid', 'ask')}
+        reason = None
+        if not by_exchange:
+            reason = f'no depth for {base} on these exchanges' + (' in this time range' if start_time or end_time else '')
+        elif None in total.values():
+            reason = 'no depth at this level for a side'
+        return {'base': base, 'level': pct, 'usd': usd, 'stat': stat, 'as_of': _to_iso(as_of) if as_of is not None else None,
+                'exchanges': by_exchange, 'total': total, 'reason': reason}
+
+    '''
+    The assets() method returns the average depths of each base asset, as create_json() does: {base: {depth column: value}}.
+    '''
+    def assets(self, usd=False, start_time=None, end_time=None):
+        self._check_range(start_time, end_time)
+        return self._answer(('assets', bool(usd), start_time, end_time))[0]
+
+    def _assets(self, usd, start_time, end_time):
+        return json.loads(self.tail.means('base', usd, start_time, end_time).to_json(orient='index'))
+
+    def status(self):
+        with self._lock:
+            memoized = len(self._memo)
+        return {'refreshed': _to_iso(int(self.refreshed * 1000)) if self.refreshed else None, 'generation': self.generation,
+                'instruments': len(self.tail.instruments), 'memoized': memoized}
+
+    def _handle(self, path, query):
+        # (status, JSON body) of an HTTP request
+        try:
+            if path == '/depth':
+                if 'base' not in query:
+                    raise ValueError('the base parameter is required')
+                exchanges = query['exchanges'].split(',') if query.get('exchanges') else None
+                key = self._depth_key(query['base'], exchanges, query.get('level', '1'), _query_flag(query.get('usd', 'true')),
+                                      query.get('stat', 'mean'), query.get('start_time'), query.get('end_time'))
+                return 200, self._answer(key)[1]
+            if path == '/assets':
+                self._check_range(query.get('start_time'), query.get('end_time'))
+                return 200, self._answer(('assets', _query_flag(query.get('usd', 'false')), query.get('start_time'), query.get('end_time')))[1]
+            if path == '/status':
+                return 200, json.dumps(self.status()).encode()
+            return 404, json.dumps({'error': f'unknown path: {path}'}).encode()
+        except ValueError as exc:
+            return 400, json.dumps({'error': str(exc)}).encode()
+        except Exception as exc:
+            return 500, json.dumps({'error': str(exc)}).encode()
+
+    '''
+    The start() method refreshes the service once (unless warm is False), then serves the HTTP API on host:port and
+    polls the tail every refresh_every seconds, from background threads. It returns the service; stop() stops it.
+    '''
+    def start(self, host='127.0.0.1', port=8080, warm=True):
+        if warm:
+            self.refresh()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                status, body = service._handle(url.path.rstrip('/'), {key: values[-1] for key, values in parse_qs(url.query).items()})
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._stop.clear()
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+        return self
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_every):
+            try:
+                self.refresh()
+            except Exception as exc:
+                print(f'refresh failed: {exc}')
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,385 @@
+'''
+Tests of the fetch engine, the snapshot cache and the rollups, against the local Kaiko API stub of the benchmarks
+(see benchmarks/kaiko_stub.py) or a session injected into KaikoClient. Run from the repository: python -m pytest tests
+'''
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+# the tests run from a checkout of the repository, kaiko_depth.py is in the parent directory and the stub in benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import kaiko_depth as kk
+from kaiko_stub import KaikoStub
+
+START, END = '2023-02-06T00:00:00Z', '2023-02-06T23:59:59Z'
+
+
+@pytest.fixture(scope='module')
+def stub():
+    with KaikoStub(page_size=50, seed=7) as stub:
+        yield stub
+
+
+def _client(stub, **kwargs):
+    kwargs = {'rate_limit': None, 'backoff': 0.001, 'max_backoff': 0.01, **kwargs}
+    return kk.KaikoClient('test', api_url=stub.api_url, reference_url=stub.reference_url, **kwargs)
+
+
+def _jobs(start_time=START, end_time=END, exchanges=['cbse', 'krkn'], pair='eth-usd'):
+    return [kk.DepthJob(exchange, 'spot', pair, start_time, end_time, '1m', {'pair': pair, 'exchange': exchange}) for exchange in exchanges]
+
+
+def _assert_same_blocks(blocks, expected):
+    assert len(blocks) == len(expected)
+    for block, other in zip(blocks, expected):
+        assert len(block) == len(other)
+        np.testing.assert_array_equal(block.timestamps, other.timestamps)
+        np.testing.assert_array_equal(block.volumes, other.volumes)
+
+
+# Time ranges
+
+def test_merge_ranges():
+    assert kk._merge_ranges([(5, 8), (0, 2), (2, 4), (7, 10)]) == [(0, 4), (5, 10)]
+    assert kk._merge_ranges([]) == []
+
+
+def test_subtract_ranges():
+    assert kk._subtract_ranges(0, 10, []) == [(0, 10)]
+    assert kk._subtract_ranges(0, 10, [(2, 4), (3, 6), (8, 12)]) == [(0, 2), (6, 8)]
+    assert kk._subtract_ranges(0, 10, [(-5, 20)]) == []
+    assert kk._subtract_ranges(5, 10, [(0, 5), (10, 15)]) == [(5, 10)]
+
+
+def test_shards_cover_the_range_newest_first():
+    shards = kk._shards(0, 1050, 100)
+    assert shards[0] == (1000, 1050) and shards[-1] == (0, 100)
+    assert sorted(shards) == [(start, min(start + 100, 1050)) for start in range(0, 1050, 100)]
+    assert kk._shards(0, 50, 100) == [(0, 50)]
+
+
+def test_stitch_keeps_boundary_snapshots_once():
+    parts = [[{'poll_timestamp': 5}, {'poll_timestamp': 4}], [{'poll_timestamp': 4}, {'poll_timestamp': 3}]]
+    assert [record['poll_timestamp'] for record in kk._stitch(parts)] == [5, 4, 3]
+
+
+# Fetchers
+
+def test_fetchers_return_string_instrument_columns(stub):
+    df = kk.market_depth('test', START, '2023-02-06T01:00:00Z', 'eth-usd', ['cbse', 'krkn'], '1m', client=_client(stub))
+    assert not any(isinstance(df[column].dtype, pd.CategoricalDtype) for column in ('exchange', 'pair'))
+    assert set(df['exchange'] + '-' + df['pair']) == {'cbse-eth-usd', 'krkn-eth-usd'}
+
+
+# HTTP client
+
+def _retried_requests(stub, **kwargs):
+    # 'request' events of a client fetching a day of prices, page after page
+    events = []
+    client = _client(stub, hooks=[lambda event, data: events.append(data) if event == 'request' else None], **kwargs)
+    url = client.crossprice_url('eth', 'usd', START, END, '1m')
+    while url:
+        url = client.get_json(url).get('next_url')
+    return events
+
+
+def test_errors_are_retried_with_backoff():
+    with KaikoStub(page_size=100, error_rate=0.3, seed=3) as stub:
+        events = _retried_requests(stub, backoff=0.001, max_backoff=0.002)
+        assert len(events) == 15 and stub.stats()['errors'] == sum(event['attempts'] - 1 for event in events) > 0
+        assert all(event['retry_wait'] <= 0.002 * (event['attempts'] - 1) for event in events)
+
+
+def test_retry_after_is_waited_entirely_or_raised():
+    with KaikoStub(page_size=100, error_rate=0.3, seed=3, retry_after=0.05) as stub:
+        # the delay asked by the API is longer than the backoff, it is waited anyway
+        events = _retried_requests(stub, backoff=0.001, max_backoff=0.002)
+        retried = [event for event in events if event['attempts'] > 1]
+        assert retried and all(event['retry_wait'] >= 0.05 * (event['attempts'] - 1) for event in retried)
+        stub.reset_stats()
+        with pytest.raises(kk.KaikoAPIError) as error:
+            _retried_requests(stub, max_retry_after=0.01)
+        assert error.value.status_code == 429 and stub.stats()['errors'] == 1
+
+
+# Sharding
+
+def test_sharded_fetch_equals_sequential_fetch(stub):
+    client = _client(stub)
+    sequential = kk.fetch_depth(client, _jobs(), shard_pages=None)
+    for shard_pages in (1, 4):
+        _assert_same_blocks(kk.fetch_depth(client, _jobs(), shard_pages=shard_pages), sequential)
+    assert np.all(np.diff(sequential[0].timestamps) < 0)
+
+
+class _FailingSession(requests.Session):
+    # answers 503 to the first request of each url matching one of fail_once, and counts the requests by url
+    def __init__(self, fail_once):
+        super().__init__()
+        self.fail_once = set(fail_once)
+        self.requests = Counter()
+
+    def get(self, url, **kwargs):
+        self.requests[url] += 1
+        matched = [part for part in self.fail_once if part in url]
+        if matched:
+            self.fail_once.discard(matched[0])
+            res = requests.Response()
+            res.status_code, res._content, res.url = 503, b'{"message": "unavailable"}', url
+            return res
+        return super().get(url, **kwargs)
+
+
+def test_failed_shard_is_downloaded_again_alone(stub):
+    expected = kk.fetch_depth(_client(stub), _jobs(exchanges=['cbse']), shard_pages=None)
+    # the shard starting at noon fails once; the client doesn't retry, the shard is downloaded again by the engine
+    session = _FailingSession(['start_time=2023-02-06T12:00:00.000Z'])
+    blocks = kk.fetch_depth(_client(stub, session=session, max_retries=0), _jobs(exchanges=['cbse']), max_workers=4, shard_pages=4)
+    _assert_same_blocks(blocks, expected)
+    first_pages = [url for url in session.requests if 'offset' not in url]
+    assert len(first_pages) > 2
+    assert all(session.requests[url] == (2 if '12:00:00.000Z' in url.split('start_time=')[1][:30] else 1) for url in first_pages)
+
+
+def test_instrument_not_listed_fails_the_job_only(stub):
+    stub.reset_stats()
+    blocks = kk.fetch_depth(_client(stub), _jobs(exchanges=['nope', 'cbse']), max_workers=2, shard_pages=1)
+    assert blocks[0] is None and len(blocks[1]) == 1440
+    # the shards of the job that aren't started yet when the 404 arrives are skipped
+    assert stub.stats()['not_found'] <= 2
+
+
+# USD prices
+
+def test_price_cache_is_per_client_and_bounded(stub):
+    client = _client(stub)
+    prices = client.price_cache.prices(client, ['eth'], START, END, '1m')['eth']
+    assert len(prices) == 1440
+    # another endpoint gets none of the prices of the stub
+    other = kk.KaikoClient('test', api_url='http://127.0.0.1:9', rate_limit=None, max_retries=0)
+    assert len(other.price_cache.prices(other, ['eth'], START, END, '1m')['eth']) == 0
+    # a bounded cache returns the whole window but only keeps its most recent prices
+    cache = kk.PriceCache(max_prices=100)
+    np.testing.assert_array_equal(cache.prices(client, ['eth'], START, END, '1m')['eth'], prices)
+    assert len(cache._prices[('eth', '1m')]) == 100
+    stub.reset_stats()
+    assert len(cache.prices(client, ['eth'], '2023-02-06T22:30:00Z', END, '1m')['eth']) == 100
+    assert stub.stats().get('price', 0) == 0
+    cache.prices(client, ['eth'], START, END, '1m')
+    assert stub.stats()['price'] > 0
+
+
+# Parquet dataset
+
+def test_parquet_sink_bounds_the_rows_buffered(stub, tmp_path):
+    path = str(tmp_path / 'dataset')
+    rows = 0
+    with kk.ParquetSink(path, max_buffered_rows=1000) as sink:
+        for block in kk.iter_depth(_client(stub), _jobs(exchanges=['cbse', 'krkn', 'stmp'])):
+            sink.write(block.to_frame())
+            rows += len(block)
+            assert sum(sink._buffered.values()) <= 1000
+        # no partition reaches row_group_size, the largest ones are written anyway
+        assert len([name for _, _, names in os.walk(path) for name in names if name.endswith('.parquet')]) == 3
+    assert rows == 3 * 1440 and len(kk.DepthDataset(path).to_frame()) == rows
+
+
+# Reporting
+
+def test_prometheus_counters_keep_all_their_digits():
+    report = kk.FetchReport()
+    report('request', {'tags': {'exchange': 'cbse'}, 'status': 200, 'attempts': 1, 'bytes': 123456789, 'wire_bytes': 12345678,
+                       'seconds': 1234.5678912, 'latency': 0.25, 'wait': 0.0, 'retry_wait': 0.0, 'decode': 0.1})
+    lines = report.to_prometheus().splitlines()
+    assert 'kaiko_depth_bytes_total{exchange="cbse"} 123456789' in lines
+    assert 'kaiko_depth_request_seconds_total{exchange="cbse"} 1234.5678912' in lines
+    assert 'kaiko_depth_request_latency_seconds_count 1' in lines
+
+
+# Snapshot cache
+
+def test_cached_and_extended_windows_equal_uncached_fetch(stub, tmp_path):
+    client = _client(stub)
+    cache = kk.SnapshotCache(str(tmp_path / 'cache.sqlite'))
+    # a few hours first, then the whole day: only the missing ranges are downloaded
+    kk.fetch_depth(client, _jobs('2023-02-06T06:00:00Z', '2023-02-06T09:59:59Z'), cache=cache, shard_pages=2)
+    assert cache.missing_ranges(_jobs()[0]) == [(kk._to_ms(START), kk._to_ms('2023-02-06T06:00:00Z')),
+                                                (kk._to_ms('2023-02-06T09:59:59Z') + 1, kk._to_ms(END) + 1)]
+    extended = kk.fetch_depth(client, _jobs(), cache=cache, shard_pages=2)
+    _assert_same_blocks(extended, kk.fetch_depth(client, _jobs(), shard_pages=None))
+    stub.reset_stats()
+    _assert_same_blocks(kk.fetch_depth(client, _jobs(), cache=cache), extended)
+    assert stub.stats().get('depth', 0) == 0
+
+
+# Rollups
+
+def test_rollup_range_means_equal_filtered_groupby(stub):
+    df = kk.DepthBlock.concat(kk.fetch_depth(_client(stub), _jobs(exchanges=['cbse', 'krkn', 'stmp']))).to_frame()
+    rollup = kk.DepthRollup.from_frame(df, ['1h', '1d'])
+    depth = kk._to_numeric(df, kk.DEPTH_COLUMNS)[kk.DEPTH_COLUMNS]
+    # whole history, then ranges that aren't aligned on the buckets: rounded inward to the hours they entirely cover
+    ranges = [(None, None, None, None),
+              ('2023-02-06T00:00:00Z', '2023-02-07T00:00:00Z', '2023-02-06T00:00:00Z', '2023-02-07T00:00:00Z'),
+              # the end time is inclusive: the last hour ends after 23:59:59.000, it isn't entirely in the range
+              ('2023-02-06T00:00:00Z', END, '2023-02-06T00:00:00Z', '2023-02-06T23:00:00Z'),
+              ('2023-02-06T03:20:00Z', '2023-02-06T17:45:00Z', '2023-02-06T04:00:00Z', '2023-02-06T17:00:00Z')]
+    for start_time, end_time, first, last in ranges:
+        if first is None:
+            selected = np.ones(len(df), dtype=bool)
+        else:
+            selected = (df['poll_timestamp'] >= kk._to_ms(first)) & (df['poll_timestamp'] < kk._to_ms(last))
+        for by in ('exchange', 'label'):
+            keys = df['exchange'].astype(str) if by == 'exchange' else df['exchange'].astype(str) + '-' + df['pair'].astype(str)
+            expected = depth[selected].groupby(keys[selected]).mean()
+            means = rollup.group_means(by, start_time=start_time, end_time=end_time)
+            pd.testing.assert_frame_equal(means.sort_index()[kk.DEPTH_COLUMNS], expected.sort_index(), check_names=False, rtol=1e-9)
+
+
+# Liquidity metrics
+
+PCTS = np.asarray(kk.DEPTH_PCTS)
+
+
+def _ladder_block(bid_density, ask_density, pairs, price_usd, timestamps=None):
+    # snapshots whose cumulative depth (base units) grows linearly with the distance to the mid price: density per %
+    volumes = np.stack([np.outer(bid_density, PCTS), np.outer(ask_density, PCTS)], axis=2)
+    keys = {'exchange': pd.Categorical(['cbse'] * len(pairs)), 'pair': pd.Categorical(pairs)}
+    timestamps = np.zeros(len(pairs), dtype=np.int64) if timestamps is None else np.asarray(timestamps, dtype=np.int64)
+    return kk.DepthBlock(volumes, timestamps, keys, {'price_usd': np.asarray(price_usd, dtype=float)})
+
+
+def test_slippage_of_a_linear_ladder():
+    ladder = np.vstack([1000 * PCTS, 1000 * PCTS])
+    ladder[1, 5] = np.nan
+    (average, impact), = kk._slippage(ladder[:1], [150])
+    # 100 filled up to 0.1% (0.05% on average), then 50 between 0.1% and 0.15%
+    np.testing.assert_allclose([average[0], impact[0]], [0.075, 0.15])
+    results = kk._slippage(ladder, [150, 5000, 10000, 20000])
+    np.testing.assert_allclose([average[0] for average, impact in results], [0.075, 2.5, 5, np.nan])
+    np.testing.assert_allclose([impact[0] for average, impact in results], [0.15, 5, 10, np.nan])
+    # a ladder with a missing level has no slippage
+    assert all(np.isnan(average[1]) and np.isnan(impact[1]) for average, impact in results)
+
+
+def test_depth_at_interpolates_between_the_levels():
+    volumes = np.stack([1000 * PCTS, 2000 * PCTS], axis=1)[None]
+    for pct, expected in ((0.05, [50, 100]), (0.15, [150, 300]), (3, [3000, 6000]), (10, [10000, 20000])):
+        np.testing.assert_allclose(kk._depth_at(volumes, pct)[0], expected)
+    assert np.isnan(kk._depth_at(volumes, 12)).all()
+
+
+def test_liquidity_metrics_of_hand_computed_ladders():
+    # bids deeper than the asks, then the opposite; a price of 2 USD doubles the notional depth
+    block = _ladder_block([1000, 3000], [3000, 1000], ['eth-usd', 'eth-usd'], [2, 2], timestamps=[0, 60000])
+    metrics = kk.liquidity_metrics(block, notionals=[300, 30000], pcts=[0.25])
+    # asks: 6000 USD per %, 300 USD are filled before 0.05%; bids: 2000 USD per %, as the linear ladder above
+    np.testing.assert_allclose(metrics.loc[0, ['buy_slippage_300', 'buy_impact_300', 'sell_slippage_300', 'sell_impact_300']],
+                               [0.025, 0.05, 0.075, 0.15])
+    # 30000 USD are beyond the 10% bid depth of the first snapshot (20000 USD)
+    assert np.isnan(metrics.loc[0, 'sell_slippage_30000']) and metrics.loc[0, 'buy_impact_30000'] == pytest.approx(5)
+    np.testing.assert_allclose(metrics[[f'imbalance{level}' for level in kk.DEPTH_LEVELS]].to_numpy(), [[-0.5] * 16, [0.5] * 16])
+    np.testing.assert_allclose(metrics[['bid_depth0_25', 'ask_depth0_25']].to_numpy(), [[500, 1500], [1500, 500]])
+    assert (metrics['base'].astype(str) == 'eth').all()
+
+
+def test_cross_exchange_liquidity_consolidates_the_venues():
+    block = _ladder_block([1000, 2000, 1000], [250, 750, 1000], ['eth-usd', 'eth-usdt', 'btc-usd'], [1, 1, 1])
+    block.volumes[1, 5:, 0] = np.nan
+    liquidity = kk.cross_exchange_liquidity(block, notionals=[150]).set_index('base')
+    assert liquidity.loc['eth', 'venues'] == 2 and liquidity.loc['btc', 'venues'] == 1
+    # the asks of the two eth venues make the linear ladder of 1000 per %
+    assert liquidity.loc['eth', 'buy_impact_150'] == pytest.approx(0.15) and liquidity.loc['eth', 'buy_slippage_150'] == pytest.approx(0.075)
+    # a missing level of a venue counts as no depth, the other venue still contributes
+    assert liquidity.loc['eth', 'total_bid_volume0_5'] == pytest.approx(1000 * 0.5 + 2000 * 0.5)
+    assert liquidity.loc['eth', 'total_bid_volume1'] == pytest.approx(1000 * 1)
+
+
+# Bulk export
+
+def test_export_completes_only_the_priced_and_published_units(stub, tmp_path):
+    instruments_file = str(tmp_path / 'instruments.json')
+    export = kk.BulkExport(str(tmp_path / 'export'), '2023-02-05T00:00:00Z', END, ['eth'], 'spot', '1m', exchanges=['cbse', 'krkn'], quote_assets=['usd'])
+    # the prices of the first day fail: its units are written without the manifest, and fetched again by the next run
+    session = _FailingSession(['spot_exchange_rate/eth/usd?start_time=2023-02-05'])
+    export.run(client=_client(stub, session=session, max_retries=0), instruments_file=instruments_file)
+    assert sorted(export.failed) == ['cbse/eth-usd/2023-02-05T00:00:00.000Z', 'krkn/eth-usd/2023-02-05T00:00:00.000Z']
+    assert [job.start_time for job in export.missing()] == ['2023-02-05T00:00:00.000Z'] * 2
+    export.run(client=_client(stub), instruments_file=instruments_file)
+    assert export.failed == [] and export.missing() == []
+    df = export.dataset().to_frame()
+    assert len(df) == 4 * 1440 and df['price_usd'].notna().all()
+
+
+def test_export_doesnt_complete_the_windows_not_published_yet(stub, tmp_path):
+    now = int(time.time() * 1000) // 60000 * 60000
+    export = kk.BulkExport(str(tmp_path / 'export'), kk._to_iso(now - 3600000), kk._to_iso(now + 59999), ['eth'], 'spot', '1m', exchanges=['cbse'],
+                           quote_assets=['usd'], window='30m')
+    export.run(client=_client(stub), instruments_file=str(tmp_path / 'instruments.json'))
+    # the window ending a millisecond before now ended less than an interval ago, as the one in progress
+    assert export.failed == [] and export.status()['completed'] == 1
+    assert [job.start_time for job in export.missing()] == [kk._to_iso(now - 1800000), kk._to_iso(now)]
+    assert os.path.exists(os.path.join(export.path, export._unit_file(export.missing()[0])))
+
+
+def test_export_completes_each_unit_as_soon_as_it_is_downloaded(stub, tmp_path):
+    export = kk.BulkExport(str(tmp_path / 'export'), START, END, ['eth'], 'spot', '1m', exchanges=['cbse', 'krkn'], quote_assets=['usd'])
+    completed = []
+
+    class Session(requests.Session):
+        # the manifest when the download of the krkn unit starts, the cbse unit is downloaded first (one worker)
+        def get(self, url, **kwargs):
+            if '/krkn/' in url and not completed:
+                completed.append(set(export.completed()))
+            return super().get(url, **kwargs)
+
+    export.run(client=_client(stub, session=Session()), max_workers=1, instruments_file=str(tmp_path / 'instruments.json'))
+    assert completed == [{'cbse/eth-usd/2023-02-06T00:00:00.000Z'}]
+    assert export.status()['completed'] == 2
+
+
+# Query service
+
+def test_service_answers_from_the_refreshed_state(stub, tmp_path):
+    tail = kk.DepthTail(None, ['eth'], '1m', START, exchanges=['cbse', 'krkn'], quote_assets=['usd'], client=_client(stub),
+                        instruments_file=str(tmp_path / 'instruments.json'), keep_frame=False)
+    # the refreshes poll the tail up to the end of the day instead of now
+    poll = tail.poll
+    tail.poll = lambda: poll(END)
+    service = kk.DepthService(tail)
+    assert service.refresh() == 2 * 1440
+    answer = service.depth('eth', level='0_5')
+    assert answer['as_of'] == '2023-02-06T23:59:00.000Z' and sorted(answer['exchanges']) == ['cbse', 'krkn']
+    # a poll in progress on the refresh thread doesn't change the answers until the refresh is done
+    tail.last_poll[('cbse', 'eth-usd')] = kk._to_ms('2023-02-07T00:00:00Z')
+    assert service.depth('eth', level='2')['as_of'] == '2023-02-06T23:59:00.000Z'
+    # no whole hour in the range: no average rather than zeros
+    status, body = service._handle('/depth', {'base': 'eth', 'start_time': '2023-02-06T05:00:00Z', 'end_time': '2023-02-06T05:30:00Z'})
+    assert status == 400 and 'bucket' in json.loads(body)['error']
+    assert service._handle('/assets', {'start_time': '2023-02-06T05:00:00Z', 'end_time': '2023-02-06T05:30:00Z'})[0] == 400
+    answer = service.depth('eth', start_time='2023-02-06T05:00:00Z', end_time='2023-02-06T06:00:00Z')
+    assert answer['total']['bid'] > 0 and answer['reason'] is None
+    # no instrument: null depths with a reason
+    for answer in (service.depth('btc'), service.depth('eth', exchanges=['stmp'])):
+        assert answer['exchanges'] == {} and answer['total'] == {'bid': None, 'ask': None} and answer['reason']
+    # a side without depth (e.g. no USD price) is null, the other side is still summed
+    latest = service._latest.copy()
+    latest.loc[latest['exchange'] == 'cbse', [column for column in kk.DEPTH_COLUMNS if column.startswith('bid')]] = np.nan
+    service._latest = latest
+    answer = service.depth('eth', exchanges=['cbse'], stat='latest', usd=False)
+    assert answer['exchanges']['cbse']['bid'] is None and answer['exchanges']['cbse']['ask'] > 0
+    assert answer['total']['bid'] is None and answer['reason']
+    assert service.depth('eth', stat='latest', usd=False)['total']['bid'] == service.depth('eth', exchanges=['krkn'], stat='latest', usd=False)['total']['bid']
+    # the unexpected errors are answered in JSON too
+    tail.means = lambda *args: 1 / 0
+    status, body = service._handle('/assets', {'usd': 'true'})
+    assert status == 500 and 'error' in json.loads(body)